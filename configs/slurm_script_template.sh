@@ -1,8 +1,5 @@
 #!/bin/bash
-#SBATCH --job-name=my_job_name        # Job name
-#SBATCH --output=output.txt           # Standard output file
-#SBATCH --error=error.txt             # Standard error file
-#SBATCH --partition=partition_name    # Partition or queue name
-#SBATCH --nodes=1                     # Number of nodes
-#SBATCH --ntasks-per-node=1           # Number of tasks per node
-#SBATCH --cpus-per-task=1             # Number of CPU cores per task
\ No newline at end of file
+#SBATCH --job-name=${job_name}
+${options}
+
+${command}
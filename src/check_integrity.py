@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+"""
+Script checks outputs of pipeline stage (runs as Slurm job of integrity check stage):
+output files are complete and have not less reads than inputs. Report is written to JSON,
+exit code is 3 if check failed (job is not retried, dependent stages are not submitted).
+
+Usage: check_integrity.py -c pod5|ubam|bam -i inputs -o outputs -r report.json [--min_read_ratio 1.0] [-t threads]
+"""
+import sys
+import os
+import json
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+from utils.integrity import INTEGRITY_CHECKS, INTEGRITY_FAILURE_EXIT_CODE, check_integrity
+
+
+def parse_cli_args() -> dict:
+    """
+    Функция для обработки аргументов командной строки
+    """
+
+    parser = argparse.ArgumentParser(
+        description = 'Проверка целостности результатов стадии обработки данных Oxford Nanopore',
+        epilog = '©Kirill Baybekov'
+    )
+
+    parser.add_argument('-c', '--check', required=True, choices=list(INTEGRITY_CHECKS), help='проверка: ' + ', '.join([f'{k} ({v})' for k, v in INTEGRITY_CHECKS.items()]))
+    parser.add_argument('-i', '--inputs', required=True, nargs='+', help='входные файлы/папки стадии')
+    parser.add_argument('-o', '--outputs', required=True, nargs='+', help='выходные файлы/папки стадии')
+    parser.add_argument('-r', '--report', required=True, type=str, help='JSON-отчёт проверки')
+    parser.add_argument('--min_read_ratio', default=1.0, type=float, help='минимальная доля прочтений на выходе от входа')
+    parser.add_argument('-t', '--threads', default=1, type=int, help='количество потоков samtools')
+
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_cli_args()
+    report = check_integrity(check=args['check'], inputs=args['inputs'], outputs=args['outputs'],
+                             min_read_ratio=args['min_read_ratio'], threads=args['threads'])
+    with open(args['report'], 'w') as f:
+        json.dump(report, f, indent=1, ensure_ascii=False)
+    print(json.dumps(report, indent=1, ensure_ascii=False))
+    if not report['passed']:
+        sys.exit(INTEGRITY_FAILURE_EXIT_CODE)
+
+
+if __name__ == "__main__":
+    main()
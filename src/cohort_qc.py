@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+"""
+Script summarizes QC of cohort processed by human_variation.py: reads QC files of samples
+(.readstats.tsv.gz, .flagstats.tsv, .mosdepth.summary.txt, .bedmethyl.gz) found in out_dir tree in parallel
+and writes one table with row per sample and mod type (reads, yield, read N50, mapping, mean coverage, methylation calls):
+outputs of mod type fan-outs of pipeline are kept apart by their {mod_type}/ dirs.
+Aggregates of files are cached in metrics_dir by file mtime, so only new or changed files are reprocessed.
+
+Usage: cohort_qc.py -o out_dir [-r report.tsv|report.parquet] [-t threads]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+from utils.common import load_yaml
+from utils.pipeline import load_pipeline
+from utils.qc import find_qc_files, load_qc_cache, save_qc_cache, summarize_cohort_qc, write_qc_table
+
+
+def parse_cli_args() -> dict:
+    """
+    Функция для обработки аргументов командной строки
+    """
+
+    parser = argparse.ArgumentParser(
+        description = 'Сводка QC когорты по результатам обработки данных Oxford Nanopore',
+        epilog = '©Kirill Baybekov'
+    )
+
+    parser.add_argument('-o', '--output_dir', required=True, type=str, help='выходная директория human_variation.py')
+    parser.add_argument('-r', '--report', default='', type=str, help='файл сводки, .tsv или .parquet (по умолчанию metrics_dir/cohort_qc.tsv)')
+    parser.add_argument('-t', '--threads', default=8, type=int, help='количество процессов для чтения файлов')
+
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_cli_args()
+    out_dir = f'{os.path.normpath(args["output_dir"])}{os.sep}'
+    directories = load_yaml(file_path=f'{configs}dir_structure.yaml', critical=True)
+    metrics_dir = f'{os.path.join(out_dir, directories["metrics_dir"]["name"])}{os.sep}'
+    os.makedirs(metrics_dir, exist_ok=True)
+    cache_file = f'{metrics_dir}cohort_qc.cache.json'
+    report = args['report'] or f'{metrics_dir}cohort_qc.tsv'
+
+    mod_types = load_pipeline(file_path=f'{configs}pipeline.yaml')['fan_out'].get('mod_type', [])
+    qc_files = find_qc_files(dir=out_dir, mod_types=mod_types)
+    if not qc_files:
+        raise FileNotFoundError(f'QC-файлы не найдены в {out_dir}')
+    table, cache = summarize_cohort_qc(qc_files=qc_files, cache=load_qc_cache(file_path=cache_file), workers=args['threads'])
+    save_qc_cache(file_path=cache_file, cache=cache)
+    write_qc_table(table=table, file_path=report)
+    print(f"QC summary of {len(table.index.unique(level='sample'))} samples: {report}")
+
+
+configs = f"{os.path.dirname(os.path.realpath(__file__).replace('src', 'configs'))}/"
+
+if __name__ == "__main__":
+    main()
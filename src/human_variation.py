@@ -1,22 +1,35 @@
 #!/usr/bin/env python3
 
 """
-Script searches for sample folders in in_dir, then checks for .fast5 files in fast5_pass subdirectories of sample.
+Script searches for sample folders in in_dir, then checks for .pod5 files in pod5_pass/pod5 subdirectories of sample
+and for .fast5 files in fast5_pass subdirectories.
 Task queue is created.
-After converting all sample's .fast5 files to .pod5 on CPU nodes, basecalling starts on GPU.
+Existing .pod5 are linked into pod5_dir, .fast5 are converted to .pod5 on CPU nodes (or basecalled directly with --fast5_on_gpu),
+then basecalling starts on GPU. With --integrity_check stage outputs are checked alongside the next stage, failed check stops the sample.
+Stages are submitted when their upstream stages are completed and stage window (configs/pipeline.yaml) has free place.
+With --daemon cohorts are taken as YAML work items from spool_dir/incoming/, --dry_run prints job plan without Slurm.
 
 Usage: Usage: nanopore_preprocessing.py in_dir pod5_dir out_dir dorado_model threads
 """
 import sys
 import os
 import time
+import shutil
 import datetime
-import pandas as pd
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import argparse
+import yaml
 from utils.common import get_dirs_in_dir, load_yaml, get_dir_size
-from utils.nanopore import aligning, basecalling, modifications_lookup, sv_lookup, convert_fast5_to_pod5, get_fast5_dirs
-from utils.slurm import get_slurm_job_status, cancel_slurm_job
+from utils.nanopore import aligning, basecalling, modifications_lookup, sv_lookup, convert_fast5_to_pod5, get_fast5_dirs, get_pod5_dirs, link_raw_files, integrity_check, \
+    get_converted_pod5
+from utils.slurm import get_slurm_job_status, get_slurm_job_accounting, RETRYABLE_JOB_STATES, classify_job_failure, escalate_slurm_script, sbatch_script, \
+    get_partition_limits, get_slurm_options, validate_slurm_options, cancel_slurm_job
+from utils.pipeline import load_pipeline, expand_pipeline, get_stage_threads, init_sample_nodes, update_sample_nodes, is_sample_finished, submit_pipeline_node, choose_next_node, \
+    stop_unchecked_nodes
+from utils.integrity import load_integrity_report
+from utils.metrics import FINAL_JOB_STATES, build_job_metrics, get_paths_size, summarize_stage_metrics, timing_span, write_prometheus_textfile, write_sample_summary
 
 
 def ch_d(d):
@@ -28,19 +41,28 @@ def parse_cli_args() -> dict:
     """
     Функция для обработки аргументов командной строки
     """
-           
+
     parser = argparse.ArgumentParser(
-        description = 'Генерация и загрузка в очередь Slurm заданий по обработке данных Oxford Nanopore от .fast5 до репортов', 
+        description = 'Генерация и загрузка в очередь Slurm заданий по обработке данных Oxford Nanopore от .fast5 до репортов',
         epilog = '©Kirill Baybekov'
     )
-    
+
     # Основные аргументы с описаниями из YAML
-    parser.add_argument('-i', '--input_dir', required=True, type=str, help='директория с папками, содержащими данные Oxford Nanopore')
-    parser.add_argument('-o', '--output_dir', required=True, type=str, help='выходная директория')
-    parser.add_argument('-t', '--threads_per_machine', required=True, default='', type=str, help='количество потоков на машину')
-    parser.add_argument('-m', '--dorado_model', required=True, default='', type=str, help='папка модели dorado')
+    parser.add_argument('-i', '--input_dir', type=str, help='директория с папками, содержащими данные Oxford Nanopore')
+    parser.add_argument('-o', '--output_dir', type=str, help='выходная директория')
+    parser.add_argument('-t', '--threads_per_machine', default='', type=str, help='количество потоков на машину')
+    parser.add_argument('-m', '--dorado_model', default='', type=str, help='папка модели dorado')
     parser.add_argument('-mp', '--dorado_models_path', default='/common_share/reference_files/dorado_models/', type=str, help='папка с моделями dorado')
-    parser.add_argument('-tmp', '--tmp_dir', required=True, default='', type=str, help='папка для временных файлов')
+    parser.add_argument('-tmp', '--tmp_dir', default='', type=str, help='папка для временных файлов')
+    parser.add_argument('--max_attempts', default=3, type=int, help='максимальное количество запусков упавшей задачи (с увеличением ресурсов)')
+    parser.add_argument('--fast5_on_gpu', action='store_true',
+                        help='для образцов только с fast5: не конвертировать в pod5, dorado читает fast5 напрямую на GPU-ноде')
+    parser.add_argument('--integrity_check', action='store_true', help='проверять результаты конвертации, бейсколлинга и выравнивания параллельно со следующей стадией (упавшая проверка останавливает образец)')
+    parser.add_argument('--daemon', default='', type=str, metavar='SPOOL_DIR',
+                        help='режим демона: когорты принимаются YAML-файлами из SPOOL_DIR/incoming/, аргументы выше используются как значения по умолчанию')
+    parser.add_argument('--dry_run', action='store_true', help='вывести граф задач и ресурсы по образцам без отправки в Slurm')
+    parser.add_argument('--dry_run_sizes', action='store_true', help='в --dry_run считать размеры образцов (обход всех файлов сырых данных)')
+    parser.add_argument('--dry_run_limits', action='store_true', help='в --dry_run проверить ресурсы стадий по ограничениям разделов Slurm (нужен pyslurm)')
 
 
     # Парсим аргументы
@@ -48,6 +70,14 @@ def parse_cli_args() -> dict:
     # Преобразуем Namespace в словарь
     args = vars(args)  # Преобразуем объект Namespace в словарь
 
+    if args['daemon'] and args['dry_run']:
+        parser.error('--dry_run не используется в режиме демона')
+    # in daemon mode cohort arguments come from work items
+    if not args['daemon']:
+        missing = [arg for arg in required_cohort_args if not args[arg]]
+        if missing:
+            parser.error(f"отсутствуют обязательные аргументы: {', '.join(missing)}")
+
     return args
 
 
@@ -63,26 +93,39 @@ def store_job_ids(pending_jobs:dict,job_results:dict, sample:str, stage:str, job
     job_results[sample][stage].update({id:'' for id in job_ids})
 
 
-def generate_job_status_report(pending_jobs:dict, job_results:dict, table:pd.DataFrame, timestamp:str) -> tuple:
+def generate_job_status_report(cohort:dict, jobs_data:dict, timestamp:str) -> tuple:
+    """
+    Обновляет состояния задач когорты по общему для всех когорт снимку очереди Slurm,
+    перезапускает упавшие задачи и пишет таблицу состояний в лог когорты.
+    :param cohort: когорта (init_cohort)
+    :param jobs_data: задачи Slurm (get_slurm_job_status)
+    :return: (текст отчёта, все задачи когорты завершены)
+    """
     RED = "\033[31m"
     YELLOW = "\033[33m"
     GREEN = "\033[32m"
     BLUE = "\033[34m"
     WHITE ="\033[0m"
     PURPLE = "\033[35m"
-    status_coloring = {'PENDING':YELLOW, 'RUNNING':BLUE, 'COMPLETED':GREEN, 'FAILED':RED, 'REMOVED':PURPLE}
+    status_coloring = {'PENDING':YELLOW, 'RUNNING':BLUE, 'COMPLETED':GREEN, 'FAILED':RED, 'REMOVED':PURPLE,
+                       'TIMEOUT':RED, 'OUT_OF_MEMORY':RED, 'NODE_FAIL':RED, 'CANCELLED':PURPLE}
 
-    jobs_data = get_slurm_job_status()
+    pending_jobs = cohort['pending_jobs']
+    job_results = cohort['job_results']
+    table = cohort['report_table']
     # check if there is still any pending job
     no_pending_jobs = True
     # check every sample in pending_jobs
     for sample, stages in pending_jobs.items():
-        
+
         # check every  stage in sample
         for stage, jobs in stages.items():
             if jobs:
                 no_pending_jobs = False
-            for job in jobs:
+            # jobs list may be changed during check (cancelled, retried jobs)
+            for job in jobs.copy():
+                if job not in jobs:
+                    continue
                 # check for job in slurmd
                 job_status = jobs_data.get(int(job), 'JOB NOT FOUND')
                 # if job is found, check for its status
@@ -96,21 +139,21 @@ def generate_job_status_report(pending_jobs:dict, job_results:dict, table:pd.Dat
                     pending_jobs, job_results = remove_job_from_processing(pending_jobs=pending_jobs, job_results=job_results,
                                                                       sample=sample, stage=stage, job=job, job_state='JOB NOT FOUND')
 
-                # we need only one sv_lookup per sample, so other will be cancelled if job started
-                if stage == 'sv_lookup' and job_state == 'RUNNING' and len(jobs) > 1:
-                    job_to_cancel = jobs[1] if job == jobs[0] else jobs[0]
-                    cancel_slurm_job(job_to_cancel=int(job_to_cancel))
-                    pending_jobs, job_results = remove_job_from_processing(pending_jobs=pending_jobs, job_results=job_results,
-                                                                      sample=sample, stage=stage, job=job_to_cancel, job_state='REMOVED')
-
                 job_results[sample][stage][job] = job_state
-                
-                
+
+                # failed job is resubmitted with more resources, otherwise its dependent stages are not submitted
+                if job_state in RETRYABLE_JOB_STATES:
+                    retry_failed_job(cohort=cohort, jobs_data=jobs_data, sample=sample, stage=stage, job=job, job_state=job_state)
+
                 if job_state == 'COMPLETED':
                     pending_jobs, job_results = remove_job_from_processing(pending_jobs=pending_jobs, job_results=job_results,
                                                                       sample=sample, stage=stage, job=job, job_state='COMPLETED')
+                elif job_state in FINAL_JOB_STATES + ['JOB NOT FOUND'] and job in jobs:
+                    # job left the queue and isn't retried (cancelled, preempted, attempts are exhausted, not found in sacct)
+                    pending_jobs, job_results = remove_job_from_processing(pending_jobs=pending_jobs, job_results=job_results,
+                                                                      sample=sample, stage=stage, job=job, job_state=job_state)
 
-    data2print = [timestamp]
+    data2print = [f"{cohort['name']} (priority {cohort['priority']}, weight {cohort['weight']}): {timestamp}"]
     #check if all jobs are completed (or removed, or unknown)
     no_more_jobs = True
     for sample, stages in job_results.items():
@@ -134,7 +177,7 @@ def generate_job_status_report(pending_jobs:dict, job_results:dict, table:pd.Dat
             data2print.append(''.join(stage_data2print))
             table.loc[sample, stage] = ', '.join(stage_cell)
             #table2print.loc[sample, stage] = ', '.join(stage_cell2print)
-    
+
 
             """stage_data = []
             stage_data.append(f'\t{stage.upper()}: ')
@@ -154,11 +197,7 @@ def generate_job_status_report(pending_jobs:dict, job_results:dict, table:pd.Dat
     data2print = f'\n'.join(data2print)
     timestamp2log = timestamp + '\n'
     table2log = table.to_string().replace('\t', '    ')
-    os.system(f"""echo "{timestamp2log}{table2log}" >> {log_file}""")
-
-    #print job data
-    os.system('clear')
-    print(data2print)
+    os.system(f"""echo "{timestamp2log}{table2log}" >> {cohort['log_file']}""")
 
     # we stop to print slurm data
     if (no_pending_jobs & no_more_jobs):
@@ -166,7 +205,7 @@ def generate_job_status_report(pending_jobs:dict, job_results:dict, table:pd.Dat
     else:
         stop_slurm_monitoring = False
 
-    return (pending_jobs, job_results, table,  stop_slurm_monitoring)
+    return (data2print, stop_slurm_monitoring)
 
 def remove_job_from_processing(pending_jobs:dict, job_results:dict, sample:str, stage:str, job:int, job_state:str) -> tuple:
     pending_jobs[sample][stage].remove(job)
@@ -175,6 +214,90 @@ def remove_job_from_processing(pending_jobs:dict, job_results:dict, sample:str,
     return (pending_jobs, job_results)
 
 
+def update_job_metrics(cohort:dict, spans:dict) -> dict:
+    """
+    Обновляет метрики задач когорты по данным sacct и записывает их в metrics_dir:
+    JSON-сводку по каждому образцу и общий файл в формате Prometheus.
+    Задачи, метрики которых уже окончательные, повторно в sacct не запрашиваются, кроме проверенных задач:
+    отчёт проверки появляется после завершения задачи, и её метрики обновляются ещё раз, когда он записан
+    :param cohort: когорта; используются job_results, job_inputs ({job_id:[входные файлы/папки задачи]}),
+                   job_attempts ({job_id:номер попытки}), job_integrity_reports ({job_id:отчёт проверки результатов задачи})
+                   и jobs_metrics ({job_id:метрики задачи})
+    :param spans: замеры фаз оркестратора
+    :return: обновлённый jobs_metrics
+    """
+    job_results = cohort['job_results']
+    jobs_metrics = cohort['jobs_metrics']
+    metrics_dir = cohort['directories']['metrics_dir']['path']
+    # finished jobs, which integrity check reports are written, but not read yet
+    checked_jobs = [job for job, report in cohort['job_integrity_reports'].items() if os.path.exists(report)]
+    jobs2update = [str(job) for stages in job_results.values() for jobs in stages.values() for job in jobs
+                   if jobs_metrics.get(str(job), {}).get('state') not in FINAL_JOB_STATES or str(job) in checked_jobs]
+    accounting = get_slurm_job_accounting(job_ids=jobs2update)
+    for job in jobs2update:
+        if job not in accounting:
+            continue
+        # input size is measured once, when job is finished and its inputs are complete
+        input_bytes = 0
+        input_reads = None
+        if accounting[job]['state'] in FINAL_JOB_STATES:
+            input_bytes = get_paths_size(paths=cohort['job_inputs'].get(job, []))
+        # reads are counted by integrity check of job outputs, report is read once
+        if job in checked_jobs and accounting[job]['state'] in FINAL_JOB_STATES:
+            input_reads = load_integrity_report(file_path=cohort['job_integrity_reports'].pop(job)).get('input_reads')
+        jobs_metrics[job] = build_job_metrics(accounting=accounting[job], input_bytes=input_bytes, input_reads=input_reads,
+                                              retries=cohort['job_attempts'].get(job, 1) - 1)
+
+    stage_metrics = {}
+    for sample, stages in job_results.items():
+        sample_jobs_metrics = {stage:{str(job):jobs_metrics[str(job)] for job in jobs if str(job) in jobs_metrics}
+                               for stage, jobs in stages.items()}
+        stage_metrics[sample] = {stage:summarize_stage_metrics(jobs_metrics=stage_jobs)
+                                 for stage, stage_jobs in sample_jobs_metrics.items() if stage_jobs}
+        write_sample_summary(file_path=f"{metrics_dir}{sample}.metrics.json", sample=sample,
+                             stage_metrics=stage_metrics[sample], jobs_metrics=sample_jobs_metrics)
+    write_prometheus_textfile(file_path=f"{metrics_dir}pipeline.prom",
+                              stage_metrics=stage_metrics, spans=spans)
+    return jobs_metrics
+
+
+def retry_failed_job(cohort:dict, jobs_data:dict, sample:str, stage:str, job:str, job_state:str) -> None:
+    """
+    Повторный запуск упавшей задачи.
+    Причина падения определяется по состоянию Slurm: при нехватке памяти или времени они увеличиваются,
+    при прочих ошибках исключается нода, на которой упала задача. Новая задача заменяет упавшую в узле пайплайна.
+    Если попытки исчерпаны, память или время уже упираются в ограничения раздела, или sbatch отклонил задачу,
+    узел считается упавшим, и зависящие от него стадии образца не отправляются.
+    Номер попытки хранится в cohort['job_attempts'] (для первого запуска задачи записи нет),
+    входные файлы задачи из cohort['job_inputs'] переносятся на новую задачу.
+    """
+    pending_jobs = cohort['pending_jobs']
+    job_results = cohort['job_results']
+    job_attempts = cohort['job_attempts']
+    max_job_attempts = cohort['max_job_attempts']
+    pending_jobs, job_results = remove_job_from_processing(pending_jobs=pending_jobs, job_results=job_results,
+                                                           sample=sample, stage=stage, job=job, job_state=job_state)
+    job_info = jobs_data.get(int(job), {})
+    attempt = job_attempts.get(str(job), 1)
+    action = classify_job_failure(job_state=job_state, exit_code=job_info.get('exit_code') or '')
+
+    if action and attempt < max_job_attempts:
+        slurm_script_file = escalate_slurm_script(slurm_script_file=f"{cohort['working_dir']}{job_info['name']}.sh", action=action,
+                                                  failed_node=job_info.get('nodes') or '',
+                                                  mem_factor=retry_mem_factor, time_factor=retry_time_factor,
+                                                  limits=get_partition_limits())
+        new_job = sbatch_script(slurm_script_file=slurm_script_file) if slurm_script_file else ''
+        if not new_job:
+            print(f'{sample}: job {job} ({stage}) {job_state}, not resubmitted ({action}: partition limit is reached or sbatch rejected job)')
+            return
+        job_attempts[new_job] = attempt + 1
+        cohort['job_inputs'][new_job] = cohort['job_inputs'].get(str(job), [])
+        store_job_ids(pending_jobs=pending_jobs, job_results=job_results, sample=sample, stage=stage, job_ids=[new_job])
+        for node in cohort['sample_nodes'][sample].values():
+            node['job_ids'] = [new_job if str(j) == str(job) else j for j in node['job_ids']]
+        print(f'{sample}: job {job} ({stage}) {job_state}, resubmitted as {new_job} (attempt {attempt + 1}/{max_job_attempts}, {action})')
+
+
 def update_pending_jobs(pending_jobs, job_results):
     # check every sample in pending_jobs
     for sample, stages in pending_jobs.items():
@@ -191,7 +314,7 @@ def update_pending_jobs(pending_jobs, job_results):
                 # Если статус False, пропускаем задачу (удаляем её из pending_jobs)
                 if status == False:
                     continue
-                
+
                 # Если статус не False, оставляем задачу
                 updated_jobs.append(job_id)
 
@@ -201,135 +324,535 @@ def update_pending_jobs(pending_jobs, job_results):
     return pending_jobs
 
 
-def main():
-    pending_jobs = {}
-    job_results = {}
+@lru_cache(maxsize=None)
+def get_pipeline() -> dict:
+    """Описание пайплайна: стадии, их ресурсы и зависимости (загружается при первом обращении)"""
+    return load_pipeline(file_path=f'{configs}pipeline.yaml')
+
+
+def get_stages() -> list:
+    """Стадии пайплайна в топологическом порядке"""
+    return list(get_pipeline()['stages'].keys())
 
-    # create subdirs in dir
-    for dir_data in directories.values():
-        os.makedirs(dir_data['path'], exist_ok=True) 
 
-    sample_dirs = get_dirs_in_dir(dir=in_dir)
-    # Create dict with sample_name:[sample_fast5s_dirs] as key:val
+def get_sample_nodes(sample_data:dict) -> list:
+    """
+    Разворачивает пайплайн для образца. Стадии с requires пропускаются,
+    если у образца не выставлен хотя бы один из флагов (конвертация не нужна при наличии pod5
+    или при бейсколлинге fast5 напрямую, проверки - без --integrity_check)
+    """
+    pipeline = get_pipeline()
+    skip_stages = []
+    for stage, stage_data in pipeline['stages'].items():
+        requires = stage_data.get('requires') or []
+        requires = [requires] if isinstance(requires, str) else requires
+        if not all([sample_data.get(flag) for flag in requires]):
+            skip_stages.append(stage)
+    return expand_pipeline(pipeline=pipeline, skip_stages=skip_stages)
+
+
+def get_stage_resources(cohort:dict, node:dict) -> dict:
+    """Ресурсы задач узла из описания пайплайна: потоки, память, раздел Slurm и исключаемые ноды"""
+    pipeline = get_pipeline()
+    stage_data = pipeline['stages'][node['stage']]
+    class_data = pipeline['resource_classes'][node['resource_class']]
+    return {'threads':str(get_stage_threads(stage_data=stage_data, threads_per_machine=cohort['threads_per_machine'])),
+            'mem':stage_data['mem'],
+            'partition':class_data['partition'],
+            'exclude_nodes':class_data.get('exclude_nodes', []),
+            'working_dir':cohort['working_dir']}
+
+
+# Stage builders: submit jobs of pipeline node and return (job_ids, outputs for dependent nodes, {job_id:[input paths]})
+# Cohort of sample is passed in sample_data['cohort']
+def build_converting(node:dict, sample_data:dict, upstream_outputs:dict) -> tuple:
+    cohort = sample_data['cohort']
+    # Pulling converting task, one per job
+    job_ids = convert_fast5_to_pod5(fast5_dirs=sample_data['fast5'], sample=sample_data['name'],
+                                    out_dir=cohort['directories']['pod5_dir']['path'], **get_stage_resources(cohort=cohort, node=node))
+    return (job_ids, {}, {str(job_id):[fast5_dir] for job_id, fast5_dir in zip(job_ids, sample_data['fast5'])})
+
+
+def build_basecalling(node:dict, sample_data:dict, upstream_outputs:dict) -> tuple:
+    cohort = sample_data['cohort']
+    directories = cohort['directories']
+    # basecalling results will be stored in ubam dir of sample.
+    # pod5 dir of sample holds pod5 or links to fast5, which are basecalled without conversion
+    job_id, ubam = basecalling(sample=sample_data['name'], in_dir=directories['pod5_dir']['path'],
+                               out_dir=directories['ubam_dir']['path'], mod_type=node['fan_out_value'], model=cohort['dorado_model'],
+                               **get_stage_resources(cohort=cohort, node=node))
+    return ([job_id], {'ubam':ubam}, {str(job_id):[f"{directories['pod5_dir']['path']}{sample_data['name']}{os.sep}"]})
+
+
+def build_aligning(node:dict, sample_data:dict, upstream_outputs:dict) -> tuple:
+    cohort = sample_data['cohort']
+    # Alignment results will be stored in bam dir of sample.
+    job_id, bam = aligning(sample=sample_data['name'], ubam=upstream_outputs['ubam'], out_dir=cohort['directories']['other_dir']['path'],
+                           mod_type=node['fan_out_value'], ref=ref_fasta, **get_stage_resources(cohort=cohort, node=node))
+    # ubam is passed further for integrity check of alignment
+    return ([job_id], {'bam':bam, 'ubam':upstream_outputs['ubam']}, {str(job_id):[upstream_outputs['ubam']]})
+
+
+def build_mod_lookup(node:dict, sample_data:dict, upstream_outputs:dict) -> tuple:
+    cohort = sample_data['cohort']
+    # mod lookup results will be stored in dir of mod type, so outputs of fan-outs don't overwrite each other
+    job_id = modifications_lookup(sample=sample_data['name'], bam=upstream_outputs['bam'],
+                                  out_dir=f"{cohort['directories']['other_dir']['path']}mod/{node['fan_out_value']}/",
+                                  mod_type=node['fan_out_value'], model=cohort['dorado_model'], ref=ref_fasta,
+                                  **get_stage_resources(cohort=cohort, node=node))
+    return ([job_id], {}, {str(job_id):[upstream_outputs['bam']]})
+
+
+def build_sv_lookup(node:dict, sample_data:dict, upstream_outputs:dict) -> tuple:
+    cohort = sample_data['cohort']
+    # SV lookup results will be stored in dir of mod type of BAM
+    job_id = sv_lookup(sample=sample_data['name'], bam=upstream_outputs['bam'],
+                       out_dir=f"{cohort['directories']['other_dir']['path']}snp_sv_str_cnv/{node['fan_out_value']}/",
+                       mod_type=node['fan_out_value'], model=cohort['dorado_model'], ref=ref_fasta, tr_bed=ref_tr_bed,
+                       **get_stage_resources(cohort=cohort, node=node))
+    return ([job_id], {}, {str(job_id):[upstream_outputs['bam']]})
+
+
+def build_integrity_check(node:dict, sample_data:dict, upstream_outputs:dict) -> tuple:
+    cohort = sample_data['cohort']
+    directories = cohort['directories']
+    stage_data = get_pipeline()['stages'][node['stage']]
+    sample = sample_data['name']
+    pod5_dir = f"{directories['pod5_dir']['path']}{sample}{os.sep}"
+    # inputs and outputs of checked stage
+    if stage_data['check'] == 'pod5':
+        # only converted pod5: pod5 dir of sample may have links to pod5 written by MinKNOW too
+        inputs = sample_data['fast5']
+        outputs = [get_converted_pod5(fast5_dir=d, sample=sample, out_dir=directories['pod5_dir']['path']) for d in inputs]
+    elif stage_data['check'] == 'ubam':
+        inputs, outputs = (sample_data['fast5'] if sample_data['fast5'] and not sample_data['cpu_conversion'] else [pod5_dir]), [upstream_outputs['ubam']]
+    else:
+        inputs, outputs = [upstream_outputs['ubam']], [upstream_outputs['bam']]
+    # checked node is the only dependency of check
+    checked_key = node['depends_on'][0]
+    report = f"{directories['metrics_dir']['path']}{sample}.{checked_key.replace(':', '_')}.integrity.json"
+    # report of previous run of cohort must not be taken for report of this check
+    if os.path.exists(report):
+        os.remove(report)
+    job_id = integrity_check(sample=sample, check=stage_data['check'], inputs=inputs, outputs=outputs, report=report, key=checked_key,
+                             min_read_ratio=stage_data.get('min_read_ratio', 1.0),
+                             **get_stage_resources(cohort=cohort, node=node))
+    # read counts of report are used in metrics of checked jobs (conversion jobs share one report, so it's skipped)
+    checked_jobs = cohort['sample_nodes'][sample][checked_key]['job_ids']
+    if len(checked_jobs) == 1:
+        cohort['job_integrity_reports'][str(checked_jobs[0])] = report
+    # outputs of checked node are passed through to dependent nodes
+    return ([job_id], dict(upstream_outputs), {str(job_id):outputs})
+
+
+stage_builders = {'converting':build_converting,
+                  'basecalling':build_basecalling,
+                  'aligning':build_aligning,
+                  'mod_lookup':build_mod_lookup,
+                  'sv_lookup':build_sv_lookup,
+                  'integrity_check':build_integrity_check}
+
+
+def discover_samples(in_dir:str, fast5_on_gpu:bool=False, integrity_check:bool=False, measure_size:bool=True) -> dict:
+    """
+    Ищет образцы с сырыми данными в in_dir. pod5, уже записанные MinKNOW, не конвертируются,
+    fast5 других запусков того же образца конвертируются. С fast5_on_gpu не конвертируются
+    образцы без pod5: dorado читает их fast5 напрямую (pod5 и fast5 в одной папке dorado не читает)
+    :param integrity_check: проверять результаты стадий образцов
+    :param measure_size: считать размер образцов (обход всех файлов), без него size - None и образцы идут по имени
+    :return: {sample:{'fast5':[dirs], 'pod5':[dirs], 'size':bytes, 'cpu_conversion':bool, 'integrity_check':bool}},
+             отсортированный по размеру
+    """
+    sample_dirs = get_dirs_in_dir(dir=f'{os.path.normpath(in_dir)}{os.sep}')
     sample_data = {}
     for s in sample_dirs:
+        p5d = get_pod5_dirs(dir=s)
         f5d = get_fast5_dirs(dir=s)
-        if f5d:
-            sample_size = 0
-            for d in f5d:
-                sample_size += get_dir_size(dir_path=d)
-            sample_data.update({os.path.basename(os.path.normpath(s)):[f5d, sample_size]})
-    # sorting by 2nd element of list
-    sample_data_sorted = {k:v for k, v in sorted(sample_data.items(), key=lambda item: item[1][1])}
-    found_samples = "\n\t".join(sample_data_sorted.keys())
-    print(f'FAST5 data found for samples (sorted by size):\n\t{found_samples}')
-    time.sleep(5)
+        if p5d or f5d:
+            sample_size = sum([get_dir_size(dir_path=d) for d in p5d + f5d]) if measure_size else None
+            sample_data.update({os.path.basename(os.path.normpath(s)):{'fast5':f5d, 'pod5':p5d, 'size':sample_size,
+                                                                        'cpu_conversion':bool(f5d) and not (fast5_on_gpu and not p5d),
+                                                                        'integrity_check':integrity_check}})
+    # sorting by sample size
+    return {k:v for k, v in sorted(sample_data.items(), key=lambda item: (item[1]['size'] or 0, item[0]))}
+
+
+def validate_stage_resources(cohort:dict, limits:dict) -> None:
+    """
+    Проверяет ресурсы всех стадий пайплайна по ограничениям разделов Slurm до отправки первой задачи когорты
+    :param cohort: когорта или аргументы, из которых берутся threads_per_machine и working_dir
+    :param limits: результат get_partition_limits
+    """
+    pipeline = get_pipeline()
+    errors = []
+    for stage, stage_data in pipeline['stages'].items():
+        resources = get_stage_resources(cohort=cohort, node={'stage':stage, 'resource_class':stage_data['resource_class']})
+        options = get_slurm_options(working_dir=resources['working_dir'], partition=resources['partition'], nodes=1,
+                                    cpus_per_task=resources['threads'], mem=resources['mem'], exclude_nodes=resources['exclude_nodes'])
+        try:
+            validate_slurm_options(options=options, limits=limits)
+        except ValueError as e:
+            errors.append(f'{stage}: {e}')
+    if errors:
+        raise ValueError(f"Ресурсы стадий вне ограничений Slurm: {'; '.join(errors)}")
+
+
+def format_job_plan(cohort_args:dict, sample_data:dict) -> str:
+    """
+    План обработки для --dry_run: узлы пайплайна каждого образца в порядке отправки, их зависимости и ресурсы.
+    Slurm не используется, файлы и папки не создаются
+    """
+    pipeline = get_pipeline()
+    cohort = {'threads_per_machine':cohort_args['threads_per_machine'],
+              'working_dir':f'{os.path.normpath(cohort_args["tmp_dir"])}{os.sep}'}
+    plan = []
+    jobs_per_stage = {stage:0 for stage in get_stages()}
+    for sample, data in sample_data.items():
+        if sample in processed_samples:
+            continue
+        size = f"{data['size'] / 1024 ** 3:.1f} Gb" if data['size'] is not None else 'size not measured'
+        plan.append(f"{sample} ({'POD5' if data['pod5'] else 'FAST5'}, {size}):")
+        single_run_stages = []
+        for node in get_sample_nodes(sample_data=data):
+            resources = get_stage_resources(cohort=cohort, node=node)
+            stage_data = pipeline['stages'][node['stage']]
+            # conversion job is submitted for every fast5 dir
+            jobs = len(data['fast5']) if node['stage'] == 'converting' else 1
+            # only the first ready node of single_run stage is submitted
+            if stage_data.get('single_run'):
+                jobs = 0 if node['stage'] in single_run_stages else jobs
+                single_run_stages.append(node['stage'])
+            jobs_per_stage[node['stage']] += jobs
+            depends_on = ', '.join(node['depends_on']) or '-'
+            exclude = f", exclude {','.join(resources['exclude_nodes'])}" if resources['exclude_nodes'] else ''
+            single_run = ', single run' if stage_data.get('single_run') else ''
+            plan.append(f"\t{node['key']} x{jobs} <- {depends_on} | {resources['partition']}, {resources['threads']} threads, "
+                        f"{resources['mem']}G, window {stage_data.get('window', '-')}{exclude}{single_run}")
+    plan.append(f"Jobs: {', '.join([f'{stage} {jobs}' for stage, jobs in jobs_per_stage.items()])}")
+    return '\n'.join(plan)
+
+
+def init_cohort(cohort_args:dict, spans:dict) -> dict:
+    """
+    Создаёт когорту: пути и структуру выходной папки, копию модели dorado, список образцов с сырыми данными
+    и словари для учёта задач.
+    :param cohort_args: аргументы когорты (как у CLI), опционально name, priority и weight
+    :param spans: замеры фаз оркестратора
+    :return: когорта
+    """
+    missing = [arg for arg in required_cohort_args if not cohort_args.get(arg)]
+    if missing:
+        raise ValueError(f"Не заданы параметры когорты: {', '.join(missing)}")
+
+    in_dir = f'{os.path.normpath(os.path.join(cohort_args["input_dir"]))}{os.sep}'
+    out_dir = f'{os.path.normpath(os.path.join(cohort_args["output_dir"]))}{os.sep}'
+    #dorado_model = f'{os.path.normpath(os.path.join(cohort_args["dorado_model"]))}{os.sep}'
+    working_dir = f'{os.path.normpath(os.path.join(cohort_args["tmp_dir"]))}{os.sep}'
+    cohort = {'name':cohort_args.get('name') or os.path.basename(os.path.normpath(in_dir)),
+              'priority':int(cohort_args.get('priority', 0)),
+              'weight':float(cohort_args.get('weight', 1)),
+              'accepted':time.time(),
+              'in_dir':in_dir,
+              'out_dir':out_dir,
+              'log_file':f'{out_dir}log.txt',
+              'dorado_model':cohort_args["dorado_model"],
+              'threads_per_machine':cohort_args["threads_per_machine"],
+              'fast5_on_gpu':bool(cohort_args.get("fast5_on_gpu")),
+              'integrity_check':bool(cohort_args.get("integrity_check")),
+              'max_job_attempts':int(cohort_args.get("max_attempts", 3)),
+              'working_dir':working_dir,
+              # unfinished jobs will be stored there.
+              # Structure: {sample:{stage1:[job_id_0, job_id_1], stage2:[job_id_2]}}
+              'pending_jobs':{},
+              # finished jobs will be stored there (logging purposes)
+              # Structure: {sample:{stage1:{job_id_0 : exit_code, job_id_1 : exit_code}, stage2:{job_id_2 : exit_code}}}
+              'job_results':{},
+              # input paths of jobs, attempts of retried jobs, metrics of jobs
+              'job_inputs':{},
+              'job_attempts':{},
+              'jobs_metrics':{},
+              # integrity check reports of checked jobs: {job_id:report}
+              'job_integrity_reports':{}}
+    if cohort['weight'] <= 0:
+        raise ValueError(f"Вес когорты {cohort['name']} должен быть больше 0")
+    # whole plan is checked before any dir is created or job is submitted
+    validate_stage_resources(cohort=cohort, limits=get_partition_limits())
+
+    if not os.path.exists(working_dir):
+        os.makedirs(working_dir, exist_ok=True)
+
+    #copy model to work dir
+    os.system(f'cp -r {cohort_args["dorado_models_path"]}{cohort["dorado_model"]} {working_dir}')
+
+    # generate paths strings for subdirs in out_dir
+    directories = load_yaml(file_path=f'{configs}dir_structure.yaml')
+    for d in directories.keys():
+        directories[d]['path'] = f'{os.path.join(out_dir, directories[d]["name"])}{os.sep}'
+    cohort['directories'] = directories
+
+    # create subdirs in dir
+    for dir_data in directories.values():
+        os.makedirs(dir_data['path'], exist_ok=True)
+
+    with timing_span(spans, 'discovery'):
+        cohort['sample_data'] = discover_samples(in_dir=in_dir, fast5_on_gpu=cohort['fast5_on_gpu'],
+                                                  integrity_check=cohort['integrity_check'])
     #print(sample_data)
     # Create list of samples for iteration
-    samples = list(sample_data_sorted.keys())
-    #?? we already processed these samples
-    for s in ['770720000101', '770720030104']:
-        samples.remove(s)
+    cohort['samples'] = [s for s in cohort['sample_data'].keys() if s not in processed_samples]
     #print(samples)
-    # Loop will proceed until we're out of jobs for submitting or samples to process
+    # pipeline nodes of samples and their states, nodes are submitted one by one
+    cohort['sample_nodes'] = {s:init_sample_nodes(nodes=get_sample_nodes(sample_data=cohort['sample_data'][s])) for s in cohort['samples']}
     #table for online report
-    report_table = pd.DataFrame(data={'sample':samples})
-    for st in stages:
+    import pandas as pd
+    report_table = pd.DataFrame(data={'sample':cohort['samples']})
+    for st in get_stages():
         report_table[st] = ''
     report_table.set_index(keys='sample', inplace=True)
+    cohort['report_table'] = report_table
     #ch_d(report_table)
-    while samples or pending_jobs:
-        # Choose sample
-        if samples:
-            sample_job_ids = {}
-            for stage in stages:
-                sample_job_ids[stage] = []
-
-            #SHIT IN STRING BELOW CREATES [] JUST ONCE, NEXT VALS WILL BE JUST LINKS. IF U CHANGE 1 VAL, U CHANGE ALL   
-            #sample_job_ids = dict.fromkeys(stages, [])
-            
-            #print('sample_job_ids', sample_job_ids)
-            # pop sample from initial sample list
-            sample = samples.pop(0)
-            #print('sample', sample)
-            pending_jobs = create_sample_sections_in_dict(target_dict=pending_jobs, sample=sample,
-                                                          sections=stages, val=[])
-            job_results = create_sample_sections_in_dict(target_dict=job_results, sample=sample,
-                                                          sections=stages, val={})
-            fast5_dirs = sample_data_sorted[sample][0]
-            #print('pending_jobs', pending_jobs, 'job_results', job_results)
-            #exit()
-            # Pulling converting task, one per job
-            #print(sample_job_ids)
-            sample_job_ids['converting'] = convert_fast5_to_pod5(fast5_dirs=fast5_dirs, sample=sample,
-                                                                      out_dir=directories['pod5_dir']['path'],
-                                                                      threads=threads_per_converting,
-                                                                      mem=mem_per_converting,
-                                                                      exclude_nodes=exclude_node_cpu,
-                                                                      working_dir=working_dir)
-            
-            
-            #print("sample_job_ids['converting']", sample_job_ids['converting'])
-            # Basecalling, aligning and mod lookup will be performed for each modification type in list          
-            for mod_type in mod_bases:
-                # basecalling results will be stored in ubam dir of sample.
-                #GPU
-                #print(sample_job_ids['basecalling'])
-                job_id_basecalling, ubam = basecalling(sample=sample,
-                                                 in_dir=directories['pod5_dir']['path'],
-                                                 out_dir=directories['ubam_dir']['path'],
-                                                mod_type=mod_type, model=dorado_model,
-                                                mem=mem_per_basecalling, threads=threads_per_basecalling,
-                                                working_dir=working_dir,
-                                                dependency=sample_job_ids['converting'])
-                sample_job_ids['basecalling'].append(job_id_basecalling)
-                #print('job_id_basecalling', job_id_basecalling)
-                #print(job_id_basecalling, ubam, sample_job_ids['basecalling'])
-                
-                # Alignment results will be stored in bam dir of sample.
-                #CPU
-                job_id_aligning, bam = aligning(sample=sample, ubam=ubam, out_dir=directories['other_dir']['path'],
-                                           mod_type=mod_type, ref=ref_fasta, threads=threads_per_align, mem=mem_per_align,
-                                           dependency=[job_id_basecalling], working_dir=working_dir, exclude_nodes=exclude_node_cpu)
-                sample_job_ids['aligning'].append(job_id_aligning)
-                #print('job_id_aligning', job_id_aligning)
-
-                # mod lookup results will be stored in common dir of sample.
-                #CPU
-                sample_job_ids['mod_lookup'].append(modifications_lookup(sample=sample, bam=bam, out_dir=f"{directories['other_dir']['path']}mod/",
-                                                     mod_type=mod_type, model=dorado_model, ref=ref_fasta, mem=mem_per_calling_mod,
-                                                     threads=threads_per_calling_mod, dependency=[job_id_aligning], working_dir=working_dir, exclude_nodes=exclude_node_cpu))
-
-                # SV calling will be performed just once with using of the first ready BAM 
-                # SV lookup results will be stored in common dir of sample.
-                #CPU
-                sample_job_ids['sv_lookup'].append(sv_lookup(sample=sample, bam=bam, out_dir=f"{directories['other_dir']['path']}snp_sv_str_cnv/",
-                                                        mod_type=mod_type, model=dorado_model, ref=ref_fasta, mem=mem_per_calling_sv,
-                                                        tr_bed=ref_tr_bed, threads=threads_per_calling_sv, dependency=[job_id_aligning],
-                                                        working_dir=working_dir, exclude_nodes=exclude_node_cpu))
-            
-            # Sample related job ids will be stored in logging dict
-            #print(sample_job_ids)
-            #print('job_results', job_results)
-            for stage, job_ids in sample_job_ids.items():
-                store_job_ids(pending_jobs=pending_jobs, job_results=job_results,
-                              sample=sample, stage=stage, job_ids=job_ids)            
-            
-            #print(job_results)
-            #os.system('scancel -u kbajbekov && rm -rf /common_share/tmp/slurm/*')
-            #exit()
+    return cohort
+
+
+def release_node(cohort:dict, sample:str, node:dict, spans:dict) -> None:
+    """Отправляет в Slurm задачи узла пайплайна образца когорты"""
+    sample_data = cohort['sample_data'][sample]
+    # the first node of sample: sample is removed from initial sample list
+    if sample in cohort['samples']:
+        cohort['samples'].remove(sample)
+        #print('sample', sample)
+        create_sample_sections_in_dict(target_dict=cohort['pending_jobs'], sample=sample, sections=get_stages(), val=[])
+        create_sample_sections_in_dict(target_dict=cohort['job_results'], sample=sample, sections=get_stages(), val={})
+        if sample_data['pod5']:
+            # pod5 written by MinKNOW are linked to pod5_dir, no conversion needed
+            link_raw_files(raw_dirs=sample_data['pod5'], sample=sample, out_dir=cohort['directories']['pod5_dir']['path'])
+        elif sample_data['fast5'] and not sample_data['cpu_conversion']:
+            # fast5 are basecalled directly (--fast5_on_gpu)
+            link_raw_files(raw_dirs=sample_data['fast5'], sample=sample, out_dir=cohort['directories']['pod5_dir']['path'],
+                           extension='.fast5')
+    with timing_span(spans, 'submission'):
+        # outputs of completed upstream nodes are threaded to the node
+        job_inputs = submit_pipeline_node(node=node, sample_nodes=cohort['sample_nodes'][sample], stage_builders=stage_builders,
+                                          sample_data={**sample_data, 'name':sample, 'cohort':cohort})
+
+    # Sample related job ids will be stored in logging dict
+    store_job_ids(pending_jobs=cohort['pending_jobs'], job_results=cohort['job_results'],
+                  sample=sample, stage=node['stage'], job_ids=node['job_ids'])
+    cohort['job_inputs'].update(job_inputs)
+    #print(job_results)
+    #os.system('scancel -u kbajbekov && rm -rf /common_share/tmp/slurm/*')
+    #exit()
+
+
+def stop_cohort(cohort:dict, error:Exception) -> None:
+    """
+    Останавливает когорту после ошибки отправки: новые узлы её образцов не отправляются,
+    уже отправленные задачи дорабатывают. Другие когорты продолжают обработку
+    """
+    cohort['error'] = f'{type(error).__name__}: {error}'
+    cohort['samples'] = []
+    for sample_nodes in cohort['sample_nodes'].values():
+        for node in sample_nodes.values():
+            if node['state'] == 'waiting':
+                node['state'] = 'failed'
+    print(f"{cohort['name']}: submission failed, cohort is stopped ({cohort['error']})")
+    with open(cohort['log_file'], 'a') as f:
+        f.write(f"Submission failed, cohort is stopped: {cohort['error']}\n")
+
+
+def release_nodes(cohorts:list, spans:dict) -> None:
+    """
+    Отправляет готовые узлы пайплайна, пока в окнах стадий есть места.
+    Каждое следующее место получает когорта, выбранная по приоритету и взвешенной справедливой доле.
+    Ошибка отправки (например, ресурсы стадии вне ограничений раздела) останавливает только свою когорту
+    """
+    while True:
+        next_node = choose_next_node(cohorts=cohorts, pipeline=get_pipeline())
+        if not next_node:
+            break
+        cohort, sample, node = next_node
+        try:
+            release_node(cohort=cohort, sample=sample, node=node, spans=spans)
+        except (ValueError, OSError) as e:
+            stop_cohort(cohort=cohort, error=e)
+
+
+def init_work_item(cohort_args:dict) -> tuple:
+    """
+    Инициализация когорты задания в потоке приёма: поиск образцов (с обходом всех файлов сырых данных)
+    и копирование модели dorado не задерживают опрос и отправку задач других когорт
+    :return: (когорта, замеры фаз её инициализации)
+    """
+    spans = {}
+    return (init_cohort(cohort_args=cohort_args, spans=spans), spans)
+
+
+def accept_work_items(spool_dir:str, cohort_defaults:dict, cohorts:list, spans:dict, intake:dict, executor) -> list:
+    """
+    Принимает когорты из YAML-файлов в spool_dir/incoming/ (файл нужно записывать под другим именем
+    и переименовывать в .yaml, чтобы не прочитать его недописанным).
+    Задание проверяется сразу, а когорта инициализируется в executor (init_work_item), пока файл остаётся в incoming/;
+    готовые когорты забираются при следующих вызовах.
+    Принятые файлы переносятся в accepted/, ошибочные (в т.ч. не YAML или не словарь) - в rejected/ вместе с описанием ошибки.
+    :param cohort_defaults: значения параметров когорты по умолчанию (аргументы CLI демона)
+    :param cohorts: уже принятые когорты (имена когорт должны быть уникальны)
+    :param intake: инициализируемые когорты {файл задания:(имя когорты, future)}, обновляется
+    :param executor: concurrent.futures.Executor для инициализации когорт
+    :return: список новых когорт
+    """
+    def reject(work_item_file, error):
+        work_item = os.path.basename(work_item_file)
+        shutil.move(work_item_file, os.path.join(spool_dir, 'rejected', work_item))
+        with open(os.path.join(spool_dir, 'rejected', f'{work_item}.error.txt'), 'w') as f:
+            f.write(f'{error}\n')
+
+    new_cohorts = []
+    # cohorts initialized since the last call
+    for work_item_file, (_name, future) in list(intake.items()):
+        if not future.done():
+            continue
+        del intake[work_item_file]
+        try:
+            cohort, cohort_spans = future.result()
+        except (ValueError, TypeError, OSError) as e:
+            reject(work_item_file=work_item_file, error=e)
+            continue
+        for name, span in cohort_spans.items():
+            total = spans.setdefault(name, {'calls':0, 'seconds':0.0, 'last_seconds':0.0})
+            total.update({'calls':total['calls'] + span['calls'], 'seconds':total['seconds'] + span['seconds'],
+                          'last_seconds':span['last_seconds']})
+        cohort['work_item'] = shutil.move(work_item_file, os.path.join(spool_dir, 'accepted', os.path.basename(work_item_file)))
+        new_cohorts.append(cohort)
+
+    incoming_dir = os.path.join(spool_dir, 'incoming')
+    for work_item in sorted(os.listdir(incoming_dir)):
+        work_item_file = os.path.join(incoming_dir, work_item)
+        if not work_item.endswith(('.yaml', '.yml')) or work_item_file in intake:
+            continue
+        try:
+            work_item_args = load_yaml(file_path=work_item_file, critical=True) or {}
+            if not isinstance(work_item_args, dict):
+                raise ValueError(f"Задание {work_item} должно содержать словарь параметров когорты")
+            cohort_args = {**cohort_defaults, 'name':os.path.splitext(work_item)[0], **work_item_args}
+            names = [cohort['name'] for cohort in cohorts + new_cohorts] + [name for name, _future in intake.values()]
+            if cohort_args['name'] in names:
+                raise ValueError(f"Когорта {cohort_args['name']} уже обрабатывается")
+        except (ValueError, TypeError, yaml.YAMLError, OSError) as e:
+            reject(work_item_file=work_item_file, error=e)
+            continue
+        # partition limits are read by pyslurm once, in the main thread
+        get_partition_limits()
+        intake[work_item_file] = (cohort_args['name'], executor.submit(init_work_item, cohort_args))
+    return new_cohorts
+
+
+def run_cohorts(cohorts:list, spans:dict, spool_dir:str='', cohort_defaults:dict={}) -> None:
+    """
+    Общий цикл отправки и мониторинга задач: один опрос Slurm на все когорты.
+    В режиме демона (spool_dir) новые когорты принимаются на каждой итерации, и цикл не завершается;
+    иначе цикл завершается, когда все когорты обработаны.
+    """
+    # work items are initialized one by one in the background, so discovery of big cohort doesn't stall the loop
+    executor = ThreadPoolExecutor(max_workers=1) if spool_dir else None
+    intake = {}
+    # Loop will proceed until we're out of jobs for submitting or samples to process
+    while cohorts or spool_dir:
+        if spool_dir:
+            with timing_span(spans, 'intake'):
+                cohorts.extend(accept_work_items(spool_dir=spool_dir, cohort_defaults=cohort_defaults, cohorts=cohorts, spans=spans,
+                                                 intake=intake, executor=executor))
+
+        # Submit stages, which upstream stages are completed, if stage windows aren't busy by other samples
+        release_nodes(cohorts=cohorts, spans=spans)
+
+        # cohort is processed, when all its jobs are finished and no more stages are to be submitted
+        finished_cohorts = [cohort for cohort in cohorts if not cohort['pending_jobs'] and not cohort['samples']]
         # Check pending jobs
-        elif pending_jobs:
+        if any([cohort['pending_jobs'] for cohort in cohorts]):
             now = datetime.datetime.now().strftime("%d.%m.%Y %H:%M:%S")
-            pending_jobs, job_results, report_table, stop_slurm_monitoring = generate_job_status_report(pending_jobs=pending_jobs, job_results=job_results, table=report_table, timestamp=now)
-
-            if stop_slurm_monitoring:
-                print('Slurm stage finished. Goodbye!')
-                exit()
+            data2print = []
+            with timing_span(spans, 'polling'):
+                # jobs, which already left slurmctld, are looked up in sacct
+                jobs_data = get_slurm_job_status(job_ids=[job for cohort in cohorts for stages in cohort['pending_jobs'].values()
+                                                          for jobs in stages.values() for job in jobs])
+                for cohort in cohorts:
+                    if not cohort['pending_jobs']:
+                        continue
+                    cohort_data2print, stop_slurm_monitoring = generate_job_status_report(cohort=cohort, jobs_data=jobs_data, timestamp=now)
+                    data2print.append(cohort_data2print)
+                    # completed stages let dependent stages to be submitted on the next iteration
+                    for sample in cohort['job_results']:
+                        update_sample_nodes(sample_nodes=cohort['sample_nodes'][sample], job_results=cohort['job_results'][sample], pipeline=get_pipeline())
+                        # failed integrity check stops stages, which run on checked outputs
+                        for job in stop_unchecked_nodes(sample_nodes=cohort['sample_nodes'][sample], pipeline=get_pipeline()):
+                            print(f"{sample}: integrity check failed, job {job} is cancelled")
+                            cancel_slurm_job(job_to_cancel=job)
+                    if stop_slurm_monitoring and not cohort['samples'] and \
+                            all([is_sample_finished(sample_nodes=sample_nodes) for sample_nodes in cohort['sample_nodes'].values()]):
+                        finished_cohorts.append(cohort)
+            with timing_span(spans, 'metrics'):
+                for cohort in cohorts:
+                    if cohort['pending_jobs']:
+                        update_job_metrics(cohort=cohort, spans=spans)
+
+            #print job data
+            os.system('clear')
+            data2print = '\n\n'.join(data2print)
+            print(data2print)
+            if spool_dir:
+                with open(os.path.join(spool_dir, 'status.txt'), 'w') as f:
+                    f.write(f'{data2print}\n')
+
+        for cohort in finished_cohorts:
+            cohorts.remove(cohort)
+            if cohort.get('error'):
+                print(f"{cohort['name']}: stopped after submission error ({cohort['error']})")
             else:
-                # pause before next check
-                time.sleep(57)
-        
+                print(f"{cohort['name']}: all samples processed!")
+            if cohort.get('work_item'):
+                # work item of stopped cohort goes to rejected/ with its error
+                result_dir = os.path.join(spool_dir, 'rejected' if cohort.get('error') else 'done')
+                shutil.move(cohort['work_item'], os.path.join(result_dir, os.path.basename(cohort['work_item'])))
+                if cohort.get('error'):
+                    with open(os.path.join(result_dir, f"{os.path.basename(cohort['work_item'])}.error.txt"), 'w') as f:
+                        f.write(f"{cohort['error']}\n")
+
+        if cohorts or spool_dir:
+            # pause before next check
+            time.sleep(57)
+
+
+def main():
+    args = parse_cli_args()
+    # timings of orchestrator phases
+    spans = {}
+
+    if args['dry_run']:
+        print(format_job_plan(cohort_args=args, sample_data=discover_samples(in_dir=args['input_dir'], fast5_on_gpu=args['fast5_on_gpu'],
+                                                                                     integrity_check=args['integrity_check'],
+                                                                                     measure_size=args['dry_run_sizes'])))
+        if args['dry_run_limits']:
+            validate_stage_resources(cohort={'threads_per_machine':args['threads_per_machine'],
+                                             'working_dir':f'{os.path.normpath(args["tmp_dir"])}{os.sep}'},
+                                     limits=get_partition_limits())
+            print('Stage resources are within partition limits')
+        return
+
+    if args['daemon']:
+        spool_dir = args['daemon']
+        for d in ['incoming', 'accepted', 'rejected', 'done']:
+            os.makedirs(os.path.join(spool_dir, d), exist_ok=True)
+        print(f"Waiting for cohorts in {os.path.join(spool_dir, 'incoming')}")
+        run_cohorts(cohorts=[], spans=spans, spool_dir=spool_dir, cohort_defaults=args)
+        return
+
+    cohort = init_cohort(cohort_args=args, spans=spans)
+    found_samples = "\n\t".join([f"{k} ({'POD5' if v['pod5'] else 'FAST5'})" for k, v in cohort['sample_data'].items()])
+    print(f'Raw data found for samples (sorted by size):\n\t{found_samples}')
+    time.sleep(5)
+    run_cohorts(cohorts=[cohort], spans=spans)
+    print('Slurm stage finished. Goodbye!')
+
 
     #move sample's files if all tasks are completed
     """    for sample, stages in job_results.items():
@@ -347,71 +870,27 @@ def main():
         for f in files2move:
             shutil.move(src=f, dst=d_path)"""
 
-args = parse_cli_args()
-
-in_dir = f'{os.path.normpath(os.path.join(args["input_dir"]))}{os.sep}'
-out_dir = f'{os.path.normpath(os.path.join(args["output_dir"]))}{os.sep}'
-log_file = f'{out_dir}log.txt'
-#dorado_model = f'{os.path.normpath(os.path.join(args["dorado_model"]))}{os.sep}'
-dorado_model = args["dorado_model"]
-threads_per_machine = args["threads_per_machine"]
-working_dir = f'{os.path.normpath(os.path.join(args["tmp_dir"]))}{os.sep}'
-if not os.path.exists(working_dir):
-    os.makedirs(working_dir, exist_ok=True)
-
-#copy model to work dir
-os.system(f'cp -r {args["dorado_models_path"]}{dorado_model} {working_dir}')
+# cohort can't be processed without these arguments (from CLI or work item)
+required_cohort_args = ['input_dir', 'output_dir', 'threads_per_machine', 'dorado_model', 'tmp_dir']
 
 ref_fasta = '/common_share/nanopore_service_files/ref_files/GCA_000001405.15_GRCh38_no_alt_analysis_set.fna'
 ref_tr_bed = '/common_share/nanopore_service_files/ref_files/human_GRCh38_no_alt_analysis_set.trf.bed'
-mod_bases = ['5mCG_5hmCG', '5mCG']
 
-# we don't want to use dgx10 for this time as CPU node
-exclude_node_cpu = ['dgx10']
-exclude_node_gpu = []
+#?? we already processed these samples
+processed_samples = ['770720000101', '770720030104']
 
 configs = f"{os.path.dirname(os.path.realpath(__file__).replace('src', 'configs'))}/"
 
-directories = load_yaml(file_path=f'{configs}dir_structure.yaml')
-stages = ['converting', 'basecalling', 'aligning', 'sv_lookup', 'mod_lookup']
-
-# generate paths strings for subdirs in out_dir
-for d in directories.keys():
-    directories[d]['path'] = f'{os.path.join(out_dir, directories[d]["name"])}{os.sep}'
-
-# How many tasks should be run on one machine concurrently 
-tasks_per_machine_converting = '16'
-tasks_per_machine_aligning = '6'
-tasks_per_machine_calling_sv = '8'
-tasks_per_machine_calling_mod = '16'
-
-threads_per_basecalling = 256 #T
-threads_per_converting = str(min((int(threads_per_machine)//int(tasks_per_machine_converting)), 16)) #T
-threads_per_align = str(min((int(threads_per_machine)//int(tasks_per_machine_aligning)), 40)) #T
-threads_per_calling_sv = str(min((int(threads_per_machine)//int(tasks_per_machine_calling_sv)), 32))
-threads_per_calling_mod = str(min((int(threads_per_machine)//int(tasks_per_machine_calling_mod)), 16))
-
-# How many RAM per task we need
-mem_per_converting = 128
-mem_per_basecalling = 512
-mem_per_align = 32
-mem_per_calling_sv = 128
-mem_per_calling_mod = 64
+# Retry policy for failed jobs: resources are multiplied on each attempt
+retry_mem_factor = 2
+retry_time_factor = 2
 
 #how many concurrent gpu processes we need
 #concurrent_gpu_processes = 4
 """На один образец (~1,3 Тб) 8 GPU A100 тратят 104 минуты.
    Соответственно, если мы будем обрабатывать сразу 4 образца,
-   среднее затраченное время будет ~416 минут 
+   среднее затраченное время будет ~416 минут
    (увеличение времени кратно уменьшению количества видеокарт на задачу)"""
 
-# unfinished jobs will be stored there.
-# Structure: {sample:{stage1:[job_id_0, job_id_1], stage2:[job_id_2]}} 
-pending_jobs = {}
-    
-# finished jobs will be stored there (logging purposes)
-# Structure: {sample:{stage1:{job_id_0 : exit_code, job_id_1 : exit_code}, stage2:{job_id_2 : exit_code}}} 
-job_results = {}
-
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+"""
+Script builds sample x CpG methylation matrix of cohort from modkit .bedmethyl.gz files found in in_dir tree.
+CpGs of reference are shared integer index of matrix columns, bedmethyl files are streamed in chunks
+and written in parallel into memory-mapped .npy arrays: coverage (uint16) and fraction of modified calls (float32).
+Matrix row is sample and mod type ('sample:mod_type', mod type of pipeline fan-out is taken from {mod_type}/ dir of file).
+
+Usage: methylation_matrix.py -i out_dir -r ref.fasta -o out_prefix [--regions regions.bed] [--min_coverage 5] [-t threads]
+"""
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+from utils.common import get_samples_in_dir_tree
+from utils.qc import get_qc_sample_name, get_qc_mod_type, QC_FILES
+from utils.methylation import build_methylation_matrix
+from utils.pipeline import load_pipeline
+
+
+def parse_cli_args() -> dict:
+    """
+    Функция для обработки аргументов командной строки
+    """
+
+    parser = argparse.ArgumentParser(
+        description = 'Матрица метилирования образец x CpG для когорты по результатам modkit',
+        epilog = '©Kirill Baybekov'
+    )
+
+    parser.add_argument('-i', '--input_dir', required=True, type=str, help='директория с .bedmethyl.gz образцов (поиск по дереву папок)')
+    parser.add_argument('-r', '--ref', default=ref_fasta, type=str, help='FASTA референса')
+    parser.add_argument('-o', '--out_prefix', required=True, type=str, help='префикс выходных файлов')
+    parser.add_argument('--cpg_index', default='', type=str, help='кэш индекса CpG референса (.npz), по умолчанию out_prefix.cpg_index.npz')
+    parser.add_argument('--regions', default='', type=str, help='BED с регионами, CpG вне которых в матрицу не попадают')
+    parser.add_argument('--mod_code', default='m', type=str, help='код модификации modkit (m - 5mC, h - 5hmC)')
+    parser.add_argument('--min_coverage', default=1, type=int, help='минимальное покрытие CpG для расчёта доли метилирования')
+    parser.add_argument('-t', '--threads', default=8, type=int, help='количество образцов, обрабатываемых параллельно')
+
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_cli_args()
+    mod_types = load_pipeline(file_path=f'{configs}pipeline.yaml')['fan_out'].get('mod_type', [])
+    bedmethyls = {}
+    for file_path in sorted(get_samples_in_dir_tree(dir=args['input_dir'], extensions=(QC_FILES['bedmethyl']['extension'],)),
+                            key=os.path.getmtime):
+        # row per sample and mod type, the newest file is taken, if there are several files of both (rerun)
+        mod_type = get_qc_mod_type(file_path=file_path, mod_types=mod_types)
+        sample = get_qc_sample_name(file_path=file_path, mod_type=mod_type)
+        bedmethyls[f'{sample}:{mod_type}' if mod_type else sample] = file_path
+    os.makedirs(os.path.dirname(os.path.abspath(args['out_prefix'])), exist_ok=True)
+    covered = build_methylation_matrix(bedmethyls=bedmethyls, ref=args['ref'], out_prefix=args['out_prefix'],
+                                       cpg_index_file=args['cpg_index'], regions=args['regions'], mod_code=args['mod_code'],
+                                       min_coverage=args['min_coverage'], workers=args['threads'])
+    for sample, cpgs in covered.items():
+        print(f'{sample}: {cpgs} CpGs with coverage >= {args["min_coverage"]}')
+    print(f"Matrix of {len(covered)} samples: {args['out_prefix']}.coverage.npy, {args['out_prefix']}.fraction.npy")
+
+
+ref_fasta = '/common_share/nanopore_service_files/ref_files/GCA_000001405.15_GRCh38_no_alt_analysis_set.fna'
+
+configs = f"{os.path.dirname(os.path.realpath(__file__).replace('src', 'configs'))}/"
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch
 import os
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -7,10 +7,10 @@ from utils.common import get_dirs_in_dir, load_yaml
 
 class TestCommonUtils(unittest.TestCase):
 
+    @patch('os.path.isdir', side_effect=lambda path: not path.endswith('file.txt'))
     @patch('os.listdir')
-    def test_get_dirs_in_dir(self, mock_listdir):
+    def test_get_dirs_in_dir(self, mock_listdir, mock_isdir):
         mock_listdir.return_value = ['sample1', 'sample2', 'file.txt']
-        os.path.isdir = MagicMock(side_effect=lambda path: not path.endswith('file.txt'))
 
         result = get_dirs_in_dir('/test')
         self.assertEqual(result, ['/test/sample1/', '/test/sample2/'])
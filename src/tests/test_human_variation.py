@@ -0,0 +1,198 @@
+import unittest
+import os
+import sys
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import human_variation
+
+
+class TestHumanVariation(unittest.TestCase):
+
+    def test_import_without_side_effects(self):
+        # Импорт модуля не разбирает аргументы и не загружает pandas/pyslurm
+        # (модули проверяются в отдельном интерпретаторе: другие тесты могут загрузить pandas)
+        self.assertFalse(hasattr(human_variation, 'args'))
+        loaded = subprocess.run([sys.executable, '-c', "import sys; import human_variation; print(' '.join(sorted(sys.modules)))"],
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                capture_output=True, text=True, check=True).stdout.split()
+        self.assertNotIn('pyslurm', loaded)
+        self.assertNotIn('pandas', loaded)
+
+    def test_dry_run_plan(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for sample, raw_dir, ext in [('s1', 'pod5_pass', '.pod5'), ('s2', 'fast5_pass', '.fast5')]:
+                for run in ['run1', 'run2']:
+                    os.makedirs(os.path.join(tmp, sample, run, raw_dir))
+                    with open(os.path.join(tmp, sample, run, raw_dir, f'a{ext}'), 'w') as f:
+                        f.write('x')
+            sample_data = human_variation.discover_samples(in_dir=f'{tmp}{os.sep}')
+            self.assertEqual(sorted(sample_data), ['s1', 's2'])
+            self.assertFalse(sample_data['s1']['cpu_conversion'])
+            self.assertTrue(sample_data['s2']['cpu_conversion'])
+
+            plan = human_variation.format_job_plan({'threads_per_machine':'128', 'tmp_dir':tmp}, sample_data).split('\n')
+            # Образцу с pod5 конвертация не нужна, у образца с fast5 - задача на каждую папку
+            self.assertNotIn('\tconverting', '\n'.join(plan[:plan.index('s2 (FAST5, 0.0 Gb):')]))
+            self.assertIn('\tconverting x2 <- - | cpu_nodes, 8 threads, 128G, window 4, exclude dgx10', plan)
+            self.assertTrue(plan[-1].startswith('Jobs: converting 2, converting_check 0, basecalling 4'))
+
+            # Проверки целостности идут параллельно со следующей стадией, конвертация проверяется одной задачей
+            sample_data = human_variation.discover_samples(in_dir=tmp, integrity_check=True)
+            plan = human_variation.format_job_plan({'threads_per_machine':'128', 'tmp_dir':tmp}, sample_data).split('\n')
+            self.assertIn('\tconverting_check x1 <- converting | cpu_nodes, 4 threads, 8G, window 8, exclude dgx10', plan)
+            self.assertIn('\tbasecalling:5mCG x1 <- converting | gpu_nodes, 256 threads, 512G, window 4', plan)
+            self.assertTrue(plan[-1].startswith('Jobs: converting 2, converting_check 1, basecalling 4, basecalling_check 4'))
+
+            # Без подсчёта размеров файлы образцов не обходятся
+            with patch('human_variation.get_dir_size') as mock_size:
+                sample_data = human_variation.discover_samples(in_dir=tmp, measure_size=False)
+            mock_size.assert_not_called()
+            self.assertEqual(list(sample_data), ['s1', 's2'])
+            plan = human_variation.format_job_plan({'threads_per_machine':'128', 'tmp_dir':tmp}, sample_data).split('\n')
+            self.assertIn('s2 (FAST5, size not measured):', plan)
+
+    @patch('human_variation.get_partition_limits', return_value={})
+    def test_dry_run_without_slurm(self, mock_limits):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, 's1', 'run1', 'pod5_pass'))
+            open(os.path.join(tmp, 's1', 'run1', 'pod5_pass', 'a.pod5'), 'w').close()
+            argv = ['human_variation.py', '-i', tmp, '-o', tmp, '-t', '128', '-m', 'model', '-tmp', tmp, '--dry_run']
+            # Ограничения разделов запрашиваются только с --dry_run_limits
+            with patch('sys.argv', argv), patch('builtins.print'):
+                human_variation.main()
+            mock_limits.assert_not_called()
+            with patch('sys.argv', argv + ['--dry_run_limits']), patch('builtins.print'):
+                with self.assertRaises(ValueError):
+                    human_variation.main()
+
+    def test_validate_stage_resources(self):
+        cohort = {'threads_per_machine':'128', 'working_dir':'/tmp/work/'}
+        limits = {'cpu_nodes':{'max_time':None, 'max_nodes':None, 'max_cpus':128, 'max_mem':1000},
+                  'gpu_nodes':{'max_time':None, 'max_nodes':None, 'max_cpus':256, 'max_mem':1000}}
+        human_variation.validate_stage_resources(cohort, limits)
+
+        # Все стадии вне ограничений перечисляются в одной ошибке
+        limits['gpu_nodes']['max_mem'] = 256
+        limits['cpu_nodes']['max_time'] = 60
+        with self.assertRaises(ValueError) as e:
+            human_variation.validate_stage_resources(cohort, limits)
+        self.assertIn('basecalling:', str(e.exception))
+        self.assertIn('mod_lookup:', str(e.exception))
+
+    @patch('human_variation.get_slurm_job_accounting')
+    def test_update_metrics_of_checked_job(self, mock_accounting):
+        mock_accounting.return_value = {'1':{'state':'COMPLETED', 'submit':'2024-05-01T10:00:00',
+                                             'start':'2024-05-01T10:00:00', 'end':'2024-05-01T10:01:40'}}
+        with tempfile.TemporaryDirectory() as tmp:
+            report = os.path.join(tmp, 's1.aligning_5mCG.integrity.json')
+            cohort = {'job_results':{'s1':{'aligning':{'1':'COMPLETED'}}}, 'job_inputs':{}, 'job_attempts':{},
+                      'jobs_metrics':{}, 'job_integrity_reports':{'1':report},
+                      'directories':{'metrics_dir':{'path':f'{tmp}{os.sep}'}}}
+            # Задача завершилась раньше проверки: прочтений ещё нет
+            human_variation.update_job_metrics(cohort, {})
+            self.assertIsNone(cohort['jobs_metrics']['1']['input_reads'])
+
+            # Отчёт проверки записан: метрики окончательной задачи обновляются один раз
+            with open(report, 'w') as f:
+                f.write('{"input_reads": 500}')
+            human_variation.update_job_metrics(cohort, {})
+            self.assertEqual(cohort['jobs_metrics']['1']['input_reads'], 500)
+            self.assertEqual(cohort['jobs_metrics']['1']['reads_per_second'], 5)
+            self.assertEqual(cohort['job_integrity_reports'], {})
+            human_variation.update_job_metrics(cohort, {})
+            self.assertEqual(mock_accounting.call_args.kwargs['job_ids'], [])
+
+    def test_discover_mixed_samples(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # Проточные ячейки с разными версиями MinKNOW: pod5 и fast5 в одном образце
+            for run, raw_dir, ext in [('run1', 'pod5_pass', '.pod5'), ('run2', 'fast5_pass', '.fast5')]:
+                os.makedirs(os.path.join(tmp, 's1', run, raw_dir))
+                with open(os.path.join(tmp, 's1', run, raw_dir, f'a{ext}'), 'w') as f:
+                    f.write('x')
+            sample_data = human_variation.discover_samples(in_dir=tmp)['s1']
+            self.assertEqual(len(sample_data['pod5']), 1)
+            self.assertEqual(len(sample_data['fast5']), 1)
+            self.assertTrue(sample_data['cpu_conversion'])
+            # fast5 такого образца конвертируются и с --fast5_on_gpu: pod5 и fast5 нужны бейсколлингу в одной папке
+            self.assertTrue(human_variation.discover_samples(in_dir=tmp, fast5_on_gpu=True)['s1']['cpu_conversion'])
+
+    def test_accept_broken_work_items(self):
+        with tempfile.TemporaryDirectory() as spool_dir:
+            for d in ['incoming', 'accepted', 'rejected', 'done']:
+                os.makedirs(os.path.join(spool_dir, d))
+            for work_item, text in [('broken.yaml', 'input_dir: [a\n'), ('list.yaml', '- input_dir\n- output_dir\n')]:
+                with open(os.path.join(spool_dir, 'incoming', work_item), 'w') as f:
+                    f.write(text)
+            # Ошибочные задания не останавливают демон и не остаются в incoming/
+            self.assertEqual(human_variation.accept_work_items(spool_dir, {}, [], {}, {}, None), [])
+            self.assertEqual(os.listdir(os.path.join(spool_dir, 'incoming')), [])
+            self.assertEqual(sorted(os.listdir(os.path.join(spool_dir, 'rejected'))),
+                             ['broken.yaml', 'broken.yaml.error.txt', 'list.yaml', 'list.yaml.error.txt'])
+
+    @patch('human_variation.get_partition_limits', return_value={})
+    @patch('human_variation.init_cohort')
+    def test_accept_work_items_in_background(self, mock_init, mock_limits):
+        initialized = threading.Event()
+        mock_init.side_effect = lambda cohort_args, spans: initialized.wait(5) and {'name':cohort_args['name']}
+        with tempfile.TemporaryDirectory() as spool_dir, ThreadPoolExecutor(max_workers=1) as executor:
+            for d in ['incoming', 'accepted', 'rejected', 'done']:
+                os.makedirs(os.path.join(spool_dir, d))
+            with open(os.path.join(spool_dir, 'incoming', 'c1.yaml'), 'w') as f:
+                f.write('input_dir: /data/c1\n')
+            # Инициализация когорты не задерживает цикл: задание ждёт в incoming/
+            intake, spans = {}, {}
+            self.assertEqual(human_variation.accept_work_items(spool_dir, {}, [], spans, intake, executor), [])
+            self.assertEqual(human_variation.accept_work_items(spool_dir, {}, [], spans, intake, executor), [])
+            self.assertEqual(os.listdir(os.path.join(spool_dir, 'incoming')), ['c1.yaml'])
+            self.assertEqual(mock_init.call_count, 1)
+
+            initialized.set()
+            next(iter(intake.values()))[1].result()
+            cohorts = human_variation.accept_work_items(spool_dir, {}, [], spans, intake, executor)
+            self.assertEqual([cohort['name'] for cohort in cohorts], ['c1'])
+            self.assertEqual(cohorts[0]['work_item'], os.path.join(spool_dir, 'accepted', 'c1.yaml'))
+            self.assertEqual(intake, {})
+
+    def test_report_removes_finished_jobs(self):
+        import pandas as pd
+        with tempfile.TemporaryDirectory() as tmp:
+            cohort = {'name':'c', 'priority':0, 'weight':1, 'log_file':os.path.join(tmp, 'log.txt'),
+                      'pending_jobs':{'s1':{'aligning':['1', '2']}}, 'job_results':{'s1':{'aligning':{'1':'', '2':''}}},
+                      'report_table':pd.DataFrame(index=pd.Index(['s1'], name='sample'), data={'aligning':['']})}
+            # Завершённая задача (в т.ч. найденная только в sacct) и отменённая задача уходят из pending_jobs
+            jobs_data = {1:{'job_state':'COMPLETED'}, 2:{'job_state':'CANCELLED'}}
+            human_variation.generate_job_status_report(cohort, jobs_data, '01.01.2025 00:00:00')
+            self.assertEqual(cohort['pending_jobs'], {'s1':{'aligning':[]}})
+            self.assertEqual(cohort['job_results'], {'s1':{'aligning':{'1':'COMPLETED', '2':'CANCELLED'}}})
+            # На следующем опросе мониторинг когорты завершается
+            _report, stop = human_variation.generate_job_status_report(cohort, {}, '01.01.2025 00:01:00')
+            self.assertTrue(stop)
+
+    def test_release_error_stops_one_cohort(self):
+        def builder(node, sample_data, upstream_outputs):
+            if sample_data['cohort']['name'] == 'a':
+                raise ValueError('mem: 1024 > 768')
+            return (['1'], {'ubam':'s.ubam'}, {'1':[]})
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cohorts = []
+            for name in ['a', 'b']:
+                sample_data = {'s1':{'fast5':[], 'pod5':[], 'size':1, 'cpu_conversion':False, 'integrity_check':False}}
+                cohorts.append({'name':name, 'priority':0, 'weight':1, 'accepted':0, 'log_file':os.path.join(tmp, f'{name}.log'),
+                                'samples':['s1'], 'sample_data':sample_data, 'pending_jobs':{}, 'job_results':{}, 'job_inputs':{},
+                                'sample_nodes':{'s1':human_variation.init_sample_nodes(human_variation.get_sample_nodes(sample_data['s1']))}})
+            with patch.dict(human_variation.stage_builders, {'basecalling':builder}):
+                human_variation.release_nodes(cohorts, {})
+            a, b = cohorts
+            self.assertIn('ValueError', a['error'])
+            self.assertTrue(all([node['state'] == 'failed' for node in a['sample_nodes']['s1'].values()]))
+            self.assertNotIn('error', b)
+            self.assertEqual(b['sample_nodes']['s1']['basecalling:5mCG']['state'], 'submitted')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+import os
+import sys
+import tempfile
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.integrity import BGZF_EOF, get_raw_files, has_bgzf_eof, check_integrity
+
+
+class TestIntegrityUtils(unittest.TestCase):
+
+    def write_file(self, file_path, data):
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        return file_path
+
+    def test_get_raw_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in ['b.fast5', 'a.fast5', 'c.pod5']:
+                self.write_file(os.path.join(tmp, name), b'x')
+            self.assertEqual(get_raw_files([tmp], '.fast5'), [os.path.join(tmp, 'a.fast5'), os.path.join(tmp, 'b.fast5')])
+            self.assertEqual(get_raw_files([tmp, '/x/s.ubam'], '.ubam'), ['/x/s.ubam'])
+
+    def test_has_bgzf_eof(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.assertTrue(has_bgzf_eof(self.write_file(os.path.join(tmp, 'full.bam'), b'data' + BGZF_EOF)))
+            self.assertFalse(has_bgzf_eof(self.write_file(os.path.join(tmp, 'cut.bam'), b'data' + BGZF_EOF[:-1])))
+            self.assertFalse(has_bgzf_eof(self.write_file(os.path.join(tmp, 'empty.bam'), b'')))
+
+    def test_check_integrity(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            ubam = self.write_file(os.path.join(tmp, 's.ubam'), b'data' + BGZF_EOF)
+            bam = self.write_file(os.path.join(tmp, 's.bam'), b'data')
+            # Обрезанный BAM: прочтения не считаются, проверка не пройдена
+            report = check_integrity('bam', [ubam], [bam])
+            self.assertFalse(report['passed'])
+            self.assertIsNone(report['input_reads'])
+            self.assertEqual(len(report['errors']), 1)
+
+            # Нет результатов стадии
+            report = check_integrity('ubam', [tmp], [os.path.join(tmp, 'missing.ubam')])
+            self.assertFalse(report['passed'])
+            self.assertEqual(len(report['errors']), 2)
+
+            with self.assertRaises(ValueError):
+                check_integrity('cram', [ubam], [bam])
+
+
+if __name__ == '__main__':
+    unittest.main()
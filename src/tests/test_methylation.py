@@ -0,0 +1,58 @@
+import unittest
+import os
+import sys
+import gzip
+import tempfile
+import numpy as np
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.methylation import build_cpg_index, get_region_columns, build_methylation_matrix
+
+
+class TestMethylationUtils(unittest.TestCase):
+
+    def write_files(self, tmp):
+        ref = os.path.join(tmp, 'ref.fasta')
+        with open(ref, 'w') as f:
+            # CpG: chr1 1, 5; chr2 0
+            f.write('>chr1 test\nACGTA\nCGT\n>chr2\ncgaa\n')
+        bedmethyls = {}
+        for sample, lines in {'s1':['chr1\t1\t2\tm\t10\t+\t1\t2\t255,0,0\t10 50.00 5 5 0 0 0 0 0',
+                                    'chr1\t2\t3\tm\t10\t-\t2\t3\t255,0,0\t10 50.00 5 5 0 0 0 0 0',
+                                    'chr1\t5\t6\th\t10\t+\t5\t6\t255,0,0\t10 10.00 1 9 0 0 0 0 0',
+                                    'chr1\t3\t4\tm\t10\t+\t3\t4\t255,0,0\t10 10.00 1 9 0 0 0 0 0'],
+                              's2':['chr2\t0\t1\tm\t4\t+\t0\t1\t255,0,0\t4 100.00 4 0 0 0 0 0 0']}.items():
+            bedmethyls[sample] = os.path.join(tmp, f'{sample}_.wf_mods.bedmethyl.gz')
+            with gzip.open(bedmethyls[sample], 'wt') as f:
+                f.write('\n'.join(lines) + '\n')
+        return ref, bedmethyls
+
+    def test_build_cpg_index(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            ref, _ = self.write_files(tmp)
+            index = build_cpg_index(ref)
+            self.assertEqual(list(index['chroms']), ['chr1', 'chr2'])
+            self.assertEqual(list(index['offsets']), [0, 2, 3])
+            self.assertEqual(list(index['positions']), [1, 5, 0])
+
+            regions = os.path.join(tmp, 'regions.bed')
+            with open(regions, 'w') as f:
+                f.write('chr1\t4\t8\nchr2\t0\t1\n')
+            self.assertEqual(list(get_region_columns(index, regions)), [-1, 0, 1])
+
+    def test_build_methylation_matrix(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            ref, bedmethyls = self.write_files(tmp)
+            out_prefix = os.path.join(tmp, 'cohort')
+            covered = build_methylation_matrix(bedmethyls, ref, out_prefix, min_coverage=5, workers=2)
+            self.assertEqual(covered, {'s1':1, 's2':0})
+
+            coverage = np.load(f'{out_prefix}.coverage.npy', mmap_mode='r')
+            fraction = np.load(f'{out_prefix}.fraction.npy', mmap_mode='r')
+            # Вызовы обеих цепей CpG суммируются, вызовы вне CpG и других модификаций отбрасываются
+            self.assertEqual(coverage.tolist(), [[20, 0, 0], [0, 0, 4]])
+            self.assertEqual(fraction[0, 0], 0.5)
+            self.assertTrue(np.isnan(fraction[1, 2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import os
+import sys
+import json
+import tempfile
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.metrics import build_job_metrics, summarize_stage_metrics, timing_span, format_prometheus_metrics, write_sample_summary
+
+
+class TestMetricsUtils(unittest.TestCase):
+
+    def test_build_job_metrics(self):
+        accounting = {'state':'COMPLETED', 'submit':'2024-05-01T10:00:00', 'start':'2024-05-01T10:10:00',
+                      'end':'2024-05-01T10:20:00', 'nodes':'dgx01', 'requeues':1}
+        result = build_job_metrics(accounting=accounting, input_bytes=6000, input_reads=1200, retries=1)
+        self.assertEqual(result['queue_wait_seconds'], 600)
+        self.assertEqual(result['run_seconds'], 600)
+        self.assertEqual(result['bytes_per_second'], 10)
+        self.assertEqual(result['reads_per_second'], 2)
+        self.assertEqual(result['retries'], 2)
+
+        # Задача ещё в очереди
+        result = build_job_metrics(accounting={'state':'PENDING', 'submit':'2024-05-01T10:00:00', 'start':'Unknown', 'end':'Unknown'})
+        self.assertIsNone(result['queue_wait_seconds'])
+        self.assertIsNone(result['bytes_per_second'])
+
+    def test_summarize_stage_metrics(self):
+        jobs = {'1':build_job_metrics({'state':'COMPLETED', 'submit':'2024-05-01T10:00:00', 'start':'2024-05-01T10:01:00', 'end':'2024-05-01T10:05:00'}, input_bytes=100),
+                '2':build_job_metrics({'state':'COMPLETED', 'submit':'2024-05-01T10:00:00', 'start':'2024-05-01T10:02:00', 'end':'2024-05-01T10:11:00'}, input_bytes=500)}
+        result = summarize_stage_metrics(jobs_metrics=jobs)
+        self.assertEqual(result['queue_wait_seconds'], 120)
+        self.assertEqual(result['run_seconds'], 600)
+        self.assertEqual(result['input_bytes'], 600)
+        self.assertEqual(result['bytes_per_second'], 1)
+
+    def test_prometheus_and_summary(self):
+        spans = {}
+        with timing_span(spans, 'polling'):
+            pass
+        self.assertEqual(spans['polling']['calls'], 1)
+
+        stage = {'jobs':1, 'states':['COMPLETED'], 'queue_wait_seconds':5.0, 'run_seconds':None, 'input_bytes':0,
+                 'input_reads':None, 'bytes_per_second':None, 'reads_per_second':None, 'retries':0}
+        text = format_prometheus_metrics(stage_metrics={'s1':{'aligning':stage}}, spans=spans)
+        self.assertIn('nanopore_stage_queue_wait_seconds{sample="s1",stage="aligning"} 5.0', text)
+        self.assertNotIn('nanopore_stage_run_seconds{', text)
+        self.assertIn('nanopore_orchestrator_phase_calls_total{phase="polling"} 1', text)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 's1.metrics.json')
+            write_sample_summary(file_path=path, sample='s1', stage_metrics={'aligning':stage}, jobs_metrics={})
+            with open(path) as f:
+                self.assertEqual(json.load(f)['stages']['aligning']['queue_wait_seconds'], 5.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,80 +1,88 @@
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch
 import os
 import sys
+import tempfile
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils.nanopore import get_fast5_dirs, convert_fast5_to_pod5, basecalling, aligning
+from utils.nanopore import dorado_bin, get_fast5_dirs, get_pod5_dirs, link_raw_files, convert_fast5_to_pod5, basecalling, aligning
 
 
 class TestNanoporeUtils(unittest.TestCase):
+    @patch('os.path.isdir', return_value=True)
+    @patch('os.listdir', return_value=['run1', 'run2'])
     @patch('os.walk')
-    def test_get_fast5_dirs(self, mock_walk):
-        mock_walk.return_value = [
-            ('/dir/sample1/fast5_pass', [], ['file1.fast5', 'file2.fast5']),
-            ('/dir/sample2/fast5_pass', [], ['file3.fast5']),
-        ]
+    def test_get_fast5_dirs(self, mock_walk, mock_listdir, mock_isdir):
+        mock_walk.side_effect = lambda d: {'/dir/run1':[('/dir/run1/fast5_pass', [], ['file1.fast5', 'file2.fast5']),
+                                                         ('/dir/run1/fast5_fail', [], ['file3.fast5'])],
+                                           '/dir/run2':[('/dir/run2/fast5_pass', [], ['file4.fast5'])]}[d]
 
         result = get_fast5_dirs('/dir')
-        self.assertEqual(result, ['/dir/sample1/fast5_pass', '/dir/sample2/fast5_pass'])
-
-        # Проверка исключения
-        mock_walk.return_value = []
-        with self.assertRaises(FileNotFoundError):
-            get_fast5_dirs('/empty')
-
-    @patch('utils.slurm.submit_slurm_job')
+        self.assertEqual(sorted(result), ['/dir/run1/fast5_pass/', '/dir/run2/fast5_pass/'])
+
+        # Образец без fast5 (например, только с pod5)
+        mock_walk.side_effect = lambda d: []
+        self.assertEqual(get_fast5_dirs('/dir'), [])
+
+    def test_get_pod5_dirs_and_links(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sample_dir = os.path.join(tmp, 'sample1')
+            for run, raw_dir, f in [('run1', 'pod5_pass', 'a.pod5'), ('run2', 'pod5', 'a.pod5'), ('run3', 'fast5_pass', 'b.fast5')]:
+                os.makedirs(os.path.join(sample_dir, run, raw_dir))
+                open(os.path.join(sample_dir, run, raw_dir, f), 'w').close()
+
+            pod5_dirs = get_pod5_dirs(sample_dir)
+            self.assertEqual(sorted(pod5_dirs), [os.path.join(sample_dir, 'run1', 'pod5_pass', ''),
+                                                 os.path.join(sample_dir, 'run2', 'pod5', '')])
+            self.assertEqual(get_fast5_dirs(sample_dir), [os.path.join(sample_dir, 'run3', 'fast5_pass', '')])
+
+            # Ссылки из разных запусков не должны перезаписывать друг друга
+            linked_dir = link_raw_files(pod5_dirs, 'sample1', os.path.join(tmp, 'out'))
+            self.assertEqual(sorted(os.listdir(linked_dir)), ['run1_a.pod5', 'run2_a.pod5'])
+            self.assertTrue(all(os.path.islink(os.path.join(linked_dir, f)) for f in os.listdir(linked_dir)))
+
+            # fast5, которые бейсколлируются без конвертации, подключаются так же
+            link_raw_files(get_fast5_dirs(sample_dir), 'sample1', os.path.join(tmp, 'out'), extension='.fast5')
+            self.assertEqual(sorted(os.listdir(linked_dir)), ['run1_a.pod5', 'run2_a.pod5', 'run3_b.fast5'])
+
+    @patch('utils.nanopore.submit_slurm_jobs')
     def test_convert_fast5_to_pod5(self, mock_submit):
-        mock_submit.side_effect = [1001, 1002]
+        mock_submit.return_value = [1001, 1002]
 
         fast5_dirs = ['/dir/sample1/fast5_pass', '/dir/sample2/fast5_pass']
         result = convert_fast5_to_pod5(fast5_dirs, 'sample', '/output', '8', 16)
 
         self.assertEqual(result, [1001, 1002])
-        self.assertEqual(mock_submit.call_count, 2)
+        # Задачи образца отправляются одним пакетом
+        self.assertEqual(mock_submit.call_count, 1)
+        self.assertEqual(len(mock_submit.call_args.kwargs['jobs']), 2)
 
-    @patch('utils.slurm.submit_slurm_job')
+    @patch('utils.nanopore.submit_slurm_job')
     def test_basecalling(self, mock_submit):
-        mock_submit.return_value = 1003
-
-        job_id, ubam = basecalling('sample', '/input', '/output', '5mCG', 'model', [1001])
-        self.assertEqual(job_id, 1003)
-        self.assertEqual(ubam, '/output/sample/sample_5mCG.ubam')
-
-        mock_submit.assert_called_once_with(
-            "dorado basecaller --modified-bases 5mCG model /input/sample/*.pod5 > /output/sample/sample_5mCG.ubam",
-            partition="gpu_nodes",
-            nodes=1,
-            job_name="basecall_sample_5mCG",
-            dependency=[1001]
-        )
-
-    @patch('pyslurm.job')
-    @patch('utils.slurm.submit_slurm_job')
-    def test_aligning(self, mock_pyslurm_job, mock_submit):
-        # Мокаем объект, который возвращается от pyslurm.job
-        mock_job_instance = MagicMock()
-        print(mock_pyslurm_job)
-        mock_pyslurm_job.return_value = mock_job_instance
-
-        # Мокаем функцию submit_slurm_job, чтобы она возвращала фиктивный job_id
-        mock_submit.return_value = 1004  # Мокаем возвращаемое значение (ID задания)
-
-        # Вызов функции aligning, которая использует submit_slurm_job
-        job_id, bam = aligning('sample', '/input/sample_5mCG.ubam', '/output', '5mCG', 'ref.fasta', '16', [1003])
-
-        # Проверка, что функция вернула правильные значения
-        self.assertEqual(job_id, 1004)
-        self.assertEqual(bam, '/output/sample/sample_5mCG.bam')
-
-        # Проверка, что submit_slurm_job был вызван один раз
-        mock_submit.assert_called_once()
-
-        # Проверка, что pyslurm.job был вызван
-        mock_pyslurm_job.assert_called_once()
-
-        # Убедимся, что job.submit_batch_job() не вызывает ошибок
-        mock_job_instance.submit_batch_job.assert_called_once()
+        mock_submit.return_value = '1003'
+        with tempfile.TemporaryDirectory() as tmp:
+            job_id, ubam = basecalling('sample', '/input', tmp, '5mCG_5hmCG', 'model', 512, 256)
+            self.assertEqual(job_id, '1003')
+            self.assertEqual(ubam, os.path.join(tmp, 'sample', 'sample_5mCG-5hmCG.ubam'))
+            self.assertTrue(os.path.isdir(os.path.join(tmp, 'sample')))
+
+            # dorado читает папку образца в pod5_dir: pod5 или ссылки на fast5
+            mock_submit.assert_called_once_with(
+                f"{dorado_bin} basecaller model /input/sample/ --batchsize 2048 --modified-bases 5mCG_5hmCG > {ubam}",
+                partition='gpu_nodes', nodes=1, job_name='basecall_sample_5mCG_5hmCG', mem=512, cpus_per_task=256,
+                exclude_nodes=[], working_dir='')
+
+    @patch('utils.nanopore.submit_slurm_job')
+    def test_aligning(self, mock_submit):
+        mock_submit.return_value = '1004'
+
+        job_id, bam = aligning('sample', '/input/sample_5mCG.ubam', '/output', '5mCG', 'ref.fasta', '16', 32)
+        self.assertEqual(job_id, '1004')
+        self.assertEqual(bam, '/output/sample/5mCG//sample_5mCG.sorted.aligned.bam')
 
+        mock_submit.assert_called_once()
+        self.assertIn('--bam /input/sample_5mCG.ubam --out_dir /output/sample/5mCG/ --references ref.fasta --threads 16',
+                      mock_submit.call_args.args[0])
+        self.assertEqual(mock_submit.call_args.kwargs['partition'], 'cpu_nodes')
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,153 @@
+import unittest
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.pipeline import load_pipeline, sort_stages, get_stage_threads, expand_pipeline, init_sample_nodes, get_ready_nodes, update_sample_nodes, \
+    is_sample_finished, submit_pipeline_node, choose_next_node, stop_unchecked_nodes
+
+pipeline_yaml = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'configs', 'pipeline.yaml')
+# integrity checks are enabled only with --integrity_check
+check_stages = ['converting_check', 'basecalling_check', 'aligning_check']
+
+
+class TestPipelineUtils(unittest.TestCase):
+
+    def test_sort_stages(self):
+        stages = {'c':{'depends_on':['b']}, 'a':{}, 'b':{'depends_on':['a']}}
+        self.assertEqual(sort_stages(stages), ['a', 'b', 'c'])
+
+        # Проверка исключения
+        with self.assertRaises(ValueError):
+            sort_stages({'a':{'depends_on':['b']}, 'b':{'depends_on':['a']}})
+
+    def test_get_stage_threads(self):
+        self.assertEqual(get_stage_threads({'threads':256}, 128), 256)
+        self.assertEqual(get_stage_threads({'tasks_per_machine':6, 'max_threads':40}, 128), 21)
+        self.assertEqual(get_stage_threads({'tasks_per_machine':2, 'max_threads':40}, 128), 40)
+
+    def test_expand_pipeline(self):
+        pipeline = load_pipeline(pipeline_yaml)
+        nodes = {node['key']:node for node in expand_pipeline(pipeline, skip_stages=check_stages)}
+        self.assertEqual(nodes['basecalling:5mCG']['depends_on'], ['converting'])
+        self.assertEqual(nodes['aligning:5mCG']['depends_on'], ['basecalling:5mCG'])
+        self.assertEqual(nodes['mod_lookup:5mCG_5hmCG']['depends_on'], ['aligning:5mCG_5hmCG'])
+
+        # Пропущенная конвертация: бейсколлинг не зависит ни от чего
+        nodes = {node['key']:node for node in expand_pipeline(pipeline, skip_stages=['converting'] + check_stages)}
+        self.assertNotIn('converting', nodes)
+        self.assertEqual(nodes['basecalling:5mCG']['depends_on'], [])
+
+        # Проверки идут параллельно со следующими стадиями
+        nodes = {node['key']:node for node in expand_pipeline(pipeline)}
+        self.assertEqual(nodes['converting_check']['depends_on'], ['converting'])
+        self.assertEqual(nodes['basecalling:5mCG']['depends_on'], ['converting'])
+        self.assertEqual(nodes['aligning_check:5mCG']['depends_on'], ['aligning:5mCG'])
+        self.assertEqual(nodes['sv_lookup:5mCG']['depends_on'], ['aligning:5mCG'])
+
+    def test_submit_pipeline_node(self):
+        pipeline = load_pipeline(pipeline_yaml)
+        sample_nodes = init_sample_nodes(expand_pipeline(pipeline, skip_stages=check_stages))
+        submitted = []
+
+        def builder(node, sample_data, upstream_outputs):
+            job_id = str(len(submitted) + 1)
+            submitted.append((node['key'], upstream_outputs.get('out')))
+            return ([job_id], {'out':node['key']}, {job_id:[]})
+
+        builders = {node['function']:builder for node in sample_nodes.values()}
+        self.assertEqual([node['key'] for node in get_ready_nodes(sample_nodes)], ['converting'])
+        submit_pipeline_node(sample_nodes['converting'], sample_nodes, builders, {'name':'sample'})
+        self.assertEqual(get_ready_nodes(sample_nodes), [])
+
+        # Завершённая стадия открывает зависящие от неё
+        update_sample_nodes(sample_nodes, {'converting':{'1':'COMPLETED'}}, pipeline)
+        ready = [node['key'] for node in get_ready_nodes(sample_nodes)]
+        self.assertEqual(ready, ['basecalling:5mCG_5hmCG', 'basecalling:5mCG'])
+        submit_pipeline_node(sample_nodes['basecalling:5mCG'], sample_nodes, builders, {'name':'sample'})
+        self.assertEqual(submitted[-1], ('basecalling:5mCG', 'converting'))
+
+        # Упавшая стадия останавливает зависящие от неё
+        update_sample_nodes(sample_nodes, {'basecalling':{'2':'FAILED'}}, pipeline)
+        self.assertEqual(sample_nodes['mod_lookup:5mCG']['state'], 'failed')
+        self.assertEqual(sample_nodes['aligning:5mCG_5hmCG']['state'], 'waiting')
+        self.assertFalse(is_sample_finished(sample_nodes))
+
+    def test_single_run(self):
+        pipeline = load_pipeline(pipeline_yaml)
+        sample_nodes = init_sample_nodes(expand_pipeline(pipeline, skip_stages=['converting'] + check_stages))
+        for node in sample_nodes.values():
+            if node['stage'] in ['basecalling', 'aligning']:
+                node['state'] = 'completed'
+        sample_nodes['sv_lookup:5mCG']['state'] = 'submitted'
+        sample_nodes['sv_lookup:5mCG']['job_ids'] = ['1']
+        update_sample_nodes(sample_nodes, {'sv_lookup':{'1':'RUNNING'}}, pipeline)
+        self.assertEqual(sample_nodes['sv_lookup:5mCG_5hmCG']['state'], 'skipped')
+
+        # Оба выравнивания завершились за один опрос: за один проход отправки SV ищется только один раз
+        sample_nodes = init_sample_nodes(expand_pipeline(pipeline, skip_stages=['converting']))
+        for node in sample_nodes.values():
+            if node['stage'] in ['converting_check', 'basecalling', 'basecalling_check', 'aligning', 'aligning_check']:
+                node['state'] = 'completed'
+        builders = {node['function']:lambda node, sample_data, upstream_outputs: (['1'], {}, {}) for node in sample_nodes.values()}
+        released = []
+        while get_ready_nodes(sample_nodes):
+            node = get_ready_nodes(sample_nodes)[0]
+            submit_pipeline_node(node, sample_nodes, builders, {'name':'sample'})
+            released.append(node['key'])
+        self.assertEqual([key for key in released if key.startswith('sv_lookup')], ['sv_lookup:5mCG_5hmCG'])
+        self.assertEqual(sample_nodes['sv_lookup:5mCG']['state'], 'skipped')
+
+    def test_stop_unchecked_nodes(self):
+        pipeline = load_pipeline(pipeline_yaml)
+        sample_nodes = init_sample_nodes(expand_pipeline(pipeline, skip_stages=['converting', 'converting_check']))
+        for node in sample_nodes.values():
+            if node['stage'] == 'basecalling':
+                node['state'] = 'completed'
+        for job_id, key in enumerate(['basecalling_check:5mCG', 'basecalling_check:5mCG_5hmCG', 'aligning:5mCG', 'aligning:5mCG_5hmCG']):
+            sample_nodes[key].update({'state':'submitted', 'job_ids':[str(job_id)]})
+        self.assertEqual(stop_unchecked_nodes(sample_nodes, pipeline), [])
+
+        # Проверка бейсколлинга 5mCG упала (код 3): выравнивание этого uBAM отменяется, зависящие узлы не отправляются
+        update_sample_nodes(sample_nodes, {'basecalling_check':{'0':'FAILED', '1':'RUNNING'},
+                                           'aligning':{'2':'RUNNING', '3':'RUNNING'}}, pipeline)
+        self.assertEqual(stop_unchecked_nodes(sample_nodes, pipeline), ['2'])
+        self.assertEqual([key for key, node in sample_nodes.items() if node['state'] == 'failed'],
+                         ['basecalling_check:5mCG', 'aligning:5mCG', 'aligning_check:5mCG',
+                          'sv_lookup:5mCG', 'mod_lookup:5mCG'])
+        self.assertEqual(sample_nodes['aligning:5mCG_5hmCG']['state'], 'submitted')
+        # Отменённые задачи уже не отменяются повторно
+        self.assertEqual(stop_unchecked_nodes(sample_nodes, pipeline), [])
+
+    def test_choose_next_node(self):
+        pipeline = load_pipeline(pipeline_yaml)
+        nodes = expand_pipeline(pipeline, skip_stages=['converting'] + check_stages)
+        window = pipeline['stages']['basecalling']['window']
+
+        def make_cohort(name, samples, accepted, started=0):
+            sample_nodes = {s:init_sample_nodes(nodes) for s in samples}
+            for s in samples[:started]:
+                sample_nodes[s]['basecalling:5mCG']['state'] = 'submitted'
+            return {'name':name, 'priority':0, 'weight':1, 'accepted':accepted,
+                    'samples':samples[started:], 'sample_nodes':sample_nodes}
+
+        a = make_cohort('a', ['a1', 'a2'], accepted=1, started=1)
+        b = make_cohort('b', ['b1'], accepted=2)
+        # Меньшая занятая доля ресурсов
+        self.assertEqual(choose_next_node([a, b], pipeline)[:2], (b, 'b1'))
+        # Начатые образцы идут раньше новых, второй узел стадии не занимает ещё одно место
+        a['weight'], b = 4, make_cohort('b', ['b1', 'b2'], accepted=2, started=1)
+        self.assertEqual(choose_next_node([a, b], pipeline)[1:], ('a1', a['sample_nodes']['a1']['basecalling:5mCG_5hmCG']))
+        # Приоритет
+        a['weight'], b['priority'] = 1, -1
+        self.assertEqual(choose_next_node([a, b], pipeline)[0], a)
+
+        # Окна стадий общие для когорт
+        b = make_cohort('b', [f'b{i}' for i in range(window)], accepted=2, started=window - 1)
+        for cohort in [a, b]:
+            for sample, sample_nodes in cohort['sample_nodes'].items():
+                if sample not in cohort['samples']:
+                    sample_nodes['basecalling:5mCG_5hmCG']['state'] = 'submitted'
+        self.assertIsNone(choose_next_node([a, b], pipeline))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import os
+import sys
+import gzip
+import tempfile
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.qc import get_qc_sample_name, get_qc_mod_type, find_qc_files, summarize_readstats, summarize_bedmethyl, summarize_cohort_qc
+
+
+class TestQcUtils(unittest.TestCase):
+
+    def test_get_qc_sample_name(self):
+        self.assertEqual(get_qc_sample_name('/out/770720000101_.wf_mods.bedmethyl.gz'), '770720000101')
+        self.assertEqual(get_qc_sample_name('/out/s1.readstats.tsv.gz'), 's1')
+        self.assertEqual(get_qc_sample_name('/out/s1/5mCG_5hmCG/s1_5mCG-5hmCG.readstats.tsv.gz', '5mCG_5hmCG'), 's1')
+        self.assertEqual(get_qc_mod_type('/out/mod/5mCG/s1_.wf_mods.bedmethyl.gz', ['5mCG_5hmCG', '5mCG']), '5mCG')
+        self.assertEqual(get_qc_mod_type('/out/s1.readstats.tsv.gz', ['5mCG']), '')
+
+    def test_find_qc_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # Результаты двух типов модификаций не смешиваются и не вытесняют друг друга
+            for mod_type in ['5mCG_5hmCG', '5mCG']:
+                os.makedirs(os.path.join(tmp, 'mod', mod_type))
+                open(os.path.join(tmp, 'mod', mod_type, 's1_.wf_mods.bedmethyl.gz'), 'w').close()
+            qc_files = find_qc_files(tmp, mod_types=['5mCG_5hmCG', '5mCG'])
+            self.assertEqual(sorted(qc_files['s1']), ['5mCG', '5mCG_5hmCG'])
+            self.assertEqual(qc_files['s1']['5mCG']['bedmethyl'], os.path.join(tmp, 'mod', '5mCG', 's1_.wf_mods.bedmethyl.gz'))
+
+    def test_summarize_readstats(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 's1.readstats.tsv.gz')
+            with gzip.open(path, 'wt') as f:
+                f.write('name\tread_length\tmean_quality\n')
+                for i, length in enumerate([100, 200, 300, 400]):
+                    f.write(f'r{i}\t{length}\t{10 + i}\n')
+            # Чтение по частям даёт тот же результат
+            result = summarize_readstats(path, chunk_size=3)
+            self.assertEqual(result['reads'], 4)
+            self.assertEqual(result['yield_bases'], 1000)
+            self.assertEqual(result['read_n50'], 300)
+            self.assertEqual(result['mean_read_quality'], 11.5)
+
+    def test_summarize_bedmethyl(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 's1_.wf_mods.bedmethyl.gz')
+            with gzip.open(path, 'wt') as f:
+                f.write('chr1\t10\t11\tm\t10\t+\t10\t11\t255,0,0\t10 50.00 5 5 0 0 0 0 0\n')
+                f.write('chr1\t10\t11\th\t10\t+\t10\t11\t255,0,0\t10 10.00 1 9 0 0 0 0 0\n')
+                f.write('chr1\t20\t21\tm\t30\t+\t20\t21\t255,0,0\t30 50.00 15 15 0 0 0 0 0\n')
+            result = summarize_bedmethyl(path, chunk_size=2)
+            self.assertEqual(result['m_sites'], 2)
+            self.assertEqual(result['m_mod_calls'], 20)
+            self.assertEqual(result['m_mod_fraction'], 0.5)
+            self.assertEqual(result['h_valid_calls'], 10)
+
+    def test_summarize_cohort_qc_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 's1_.mosdepth.summary.txt')
+            with open(path, 'w') as f:
+                f.write('chrom\tlength\tbases\tmean\tmin\tmax\nchr1\t100\t3000\t30.00\t0\t50\ntotal\t100\t3000\t30.00\t0\t50\n')
+            qc_files = find_qc_files(tmp)
+            table, cache = summarize_cohort_qc(qc_files, cache={})
+            self.assertEqual(table.loc[('s1', ''), 'mean_coverage'], 30.0)
+
+            # Файл не изменился: агрегаты берутся из кэша
+            cache['s1']['']['mosdepth']['aggregates']['mean_coverage'] = 31.0
+            table, cache = summarize_cohort_qc(qc_files, cache=cache)
+            self.assertEqual(table.loc[('s1', ''), 'mean_coverage'], 31.0)
+
+            # Файл изменился: пересчёт
+            os.utime(path, (0, 0))
+            table, cache = summarize_cohort_qc(qc_files, cache=cache)
+            self.assertEqual(table.loc[('s1', ''), 'mean_coverage'], 30.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,31 +2,129 @@ import unittest
 from unittest.mock import patch, MagicMock
 import os
 import sys
+import tempfile
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils.slurm import submit_slurm_job, is_slurm_job_running
+from utils.slurm import get_slurm_job_status, submit_slurm_job, sbatch_scripts, classify_job_failure, slurm_time_to_minutes, scale_slurm_time, escalate_slurm_script, \
+    get_slurm_options, render_slurm_script, validate_slurm_options
 
 
 class TestSlurmUtils(unittest.TestCase):
 
-    @patch('pyslurm.job')
-    def test_submit_slurm_job(self, mock_job):
-        mock_job_instance = MagicMock()
-        mock_job.return_value = mock_job_instance
-        mock_job_instance.submit_batch_job.return_value = 1234
+    @patch('utils.slurm.get_partition_limits', return_value={'cpu_nodes':{'max_time':None, 'max_nodes':None, 'max_cpus':None, 'max_mem':None}})
+    @patch('utils.slurm.run_shell_cmd', return_value=('1234;cluster\n', ''))
+    def test_submit_slurm_job(self, mock_run, mock_limits):
+        with tempfile.TemporaryDirectory() as tmp:
+            result = submit_slurm_job('echo "Hello, World!"', tmp, 'test_job', partition='cpu_nodes')
+            self.assertEqual(result, '1234')
+            mock_run.assert_called_once_with(cmd=f"sbatch --parsable {os.path.join(tmp, 'test_job.sh')}")
 
-        result = submit_slurm_job('echo "Hello, World!"', 'test_job', 'cpu_nodes')
-        self.assertEqual(result, 1234)
+    @patch('utils.slurm.cancel_slurm_job')
+    @patch('utils.slurm.run_shell_cmd')
+    def test_sbatch_scripts(self, mock_run, mock_cancel):
+        mock_run.return_value = ('11\n12;cluster\n', '')
+        self.assertEqual(sbatch_scripts(['a.sh', 'b.sh']), ['11', '12'])
+        mock_cancel.assert_not_called()
 
-    @patch('pyslurm.job')
-    def test_is_slurm_job_running(self, mock_job):
-        mock_job_instance = MagicMock()
-        mock_job.return_value = mock_job_instance
-        mock_job_instance.find_id.return_value = {'job_state': 'RUNNING'}
+        # sbatch не принял второй скрипт: первая задача пакета отменяется
+        mock_run.return_value = ('11\n\n13\n', 'sbatch: error: Batch job submission failed')
+        with self.assertRaises(ValueError):
+            sbatch_scripts(['a.sh', 'b.sh', 'c.sh'])
+        self.assertEqual([c.kwargs['job_to_cancel'] for c in mock_cancel.call_args_list], ['11', '13'])
 
-        self.assertTrue(is_slurm_job_running('1234'))
+    @patch('utils.slurm.get_partition_limits', return_value={'cpu_nodes':{'max_time':None, 'max_nodes':None, 'max_cpus':None, 'max_mem':None}})
+    @patch('utils.slurm.run_shell_cmd', return_value=('', 'sbatch: error: invalid partition'))
+    def test_submit_slurm_job_rejected(self, mock_run, mock_limits):
+        with tempfile.TemporaryDirectory() as tmp:
+            with self.assertRaises(ValueError):
+                submit_slurm_job('echo', tmp, 'test_job', partition='cpu_nodes')
 
-        mock_job_instance.find_id.return_value = {'job_state': 'COMPLETED'}
-        self.assertFalse(is_slurm_job_running('1234'))
+    @patch('utils.slurm.get_slurm_job_accounting')
+    def test_get_slurm_job_status(self, mock_accounting):
+        pyslurm = MagicMock()
+        pyslurm.job.return_value.get.return_value = {11:{'job_state':'RUNNING', 'name':'a', 'nodes':'n1'}}
+        mock_accounting.return_value = {'12':{'job_name':'b', 'state':'COMPLETED', 'nodes':'n2', 'exit_code':'0:0'}}
+        with patch.dict(sys.modules, {'pyslurm':pyslurm}):
+            jobs_data = get_slurm_job_status(job_ids=['11', '12', '13'])
+        # Задачи, которых уже нет в slurmctld, берутся из sacct
+        mock_accounting.assert_called_once_with(job_ids=['12', '13'])
+        self.assertEqual(jobs_data[12], {'job_state':'COMPLETED', 'name':'b', 'nodes':'n2', 'exit_code':'0:0'})
+        self.assertEqual(jobs_data[11]['job_state'], 'RUNNING')
+        self.assertNotIn(13, jobs_data)
+
+    def test_render_slurm_script(self):
+        options = get_slurm_options('/tmp/work', partition='cpu_nodes', cpus_per_task=8, mem=32, dependency=['1', '2'],
+                                    array='0-3', begin='now+1hour')
+        script = render_slurm_script('echo $SLURM_ARRAY_TASK_ID', 'job', options).split('\n')
+        self.assertEqual(script[:2], ['#!/bin/bash', '#SBATCH --job-name=job'])
+        self.assertIn('#SBATCH --dependency=afterok:1:2', script)
+        self.assertIn('#SBATCH --kill-on-invalid-dep=yes', script)
+        self.assertIn('#SBATCH --array=0-3', script)
+        self.assertNotIn('#SBATCH --cpus-per-gpu=', '\n'.join(script))
+        # шаблон заканчивается переводом строки
+        self.assertEqual(script[-2:], ['echo $SLURM_ARRAY_TASK_ID', ''])
+
+        # Без зависимостей --kill-on-invalid-dep не нужен
+        self.assertNotIn('kill-on-invalid-dep', get_slurm_options('/tmp/work'))
+
+    def test_validate_slurm_options(self):
+        limits = {'cpu_nodes':{'max_time':24 * 60, 'max_nodes':None, 'max_cpus':128, 'max_mem':1000}}
+        validate_slurm_options(get_slurm_options('/tmp/work', partition='cpu_nodes', cpus_per_task=128, mem=512), limits)
+        validate_slurm_options(get_slurm_options('/tmp/work'), limits)
+
+        # Проверка исключения
+        with self.assertRaises(ValueError):
+            validate_slurm_options(get_slurm_options('/tmp/work', partition='cpu_nodes', time='2-00:00:00'), limits)
+        with self.assertRaises(ValueError):
+            validate_slurm_options(get_slurm_options('/tmp/work', partition='cpu_nodes', cpus_per_task=256), limits)
+        with self.assertRaises(ValueError):
+            validate_slurm_options(get_slurm_options('/tmp/work', partition='gpu_nodes'), limits)
+
+    def test_classify_job_failure(self):
+        self.assertEqual(classify_job_failure('OUT_OF_MEMORY'), 'mem')
+        self.assertEqual(classify_job_failure('TIMEOUT'), 'time')
+        self.assertEqual(classify_job_failure('NODE_FAIL'), 'node')
+        # SIGKILL от OOM killer
+        self.assertEqual(classify_job_failure('FAILED', '0:9'), 'mem')
+        self.assertEqual(classify_job_failure('CANCELLED'), '')
+
+    def test_slurm_time_to_minutes(self):
+        for time, minutes in [('30', 30), ('30:30', 30.5), ('8:00:00', 480), ('1-12', 2160), ('1-12:30', 2190),
+                              ('1-12:30:30', 2190.5), ('UNLIMITED', float('inf'))]:
+            self.assertEqual(slurm_time_to_minutes(time), minutes)
+
+    def test_scale_slurm_time(self):
+        self.assertEqual(scale_slurm_time('8:00:00', 2), '0-16:00:00')
+        self.assertEqual(scale_slurm_time('1-12:00:00', 1.5), '2-06:00:00')
+        self.assertEqual(scale_slurm_time('1-12', 2), '3-00:00:00')
+        self.assertEqual(scale_slurm_time('UNLIMITED', 2), 'UNLIMITED')
+
+    def test_escalate_slurm_script(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            script = os.path.join(tmp, 'job.sh')
+            with open(script, 'w') as f:
+                f.write('\n'.join(['#!/bin/bash\n', '#SBATCH --job-name=job', '#SBATCH --mem=32G',
+                                   '#SBATCH --dependency=afterok:1', '#SBATCH --time=8:00:00', '\n', 'echo']))
+            escalate_slurm_script(script, 'mem')
+            escalate_slurm_script(script, 'node', failed_node='dgx01')
+            with open(script) as f:
+                lines = f.read().split('\n')
+            self.assertIn('#SBATCH --mem=64G', lines)
+            self.assertIn('#SBATCH --exclude=dgx01', lines)
+            self.assertNotIn('#SBATCH --dependency=afterok:1', lines)
+            self.assertEqual(lines[-1], 'echo')
+
+            # Память и время не превышают ограничений раздела, упершись в них, задача не перезапускается
+            limits = {'gpu_nodes':{'max_time':24 * 60, 'max_nodes':None, 'max_cpus':256, 'max_mem':768}}
+            with open(script, 'w') as f:
+                f.write('\n'.join(['#!/bin/bash', '#SBATCH --partition=gpu_nodes', '#SBATCH --mem=512G', '#SBATCH --time=16:00:00', '', 'echo']))
+            self.assertEqual(escalate_slurm_script(script, 'mem', limits=limits), script)
+            escalate_slurm_script(script, 'time', limits=limits)
+            with open(script) as f:
+                lines = f.read().split('\n')
+            self.assertIn('#SBATCH --mem=768G', lines)
+            self.assertIn('#SBATCH --time=1-00:00:00', lines)
+            self.assertEqual(escalate_slurm_script(script, 'mem', limits=limits), '')
+            self.assertEqual(escalate_slurm_script(script, 'time', limits=limits), '')
 
 
 if __name__ == '__main__':
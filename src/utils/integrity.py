@@ -0,0 +1,118 @@
+import os
+import sys
+import json
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.common import run_shell_cmd
+
+# BGZF end-of-file marker: empty block, which samtools writes at the end of every complete BAM
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+# exit code of check_integrity.py, if data are broken: job is not retried, dependent stages are not submitted
+INTEGRITY_FAILURE_EXIT_CODE = 3
+# checks of pipeline stages outputs: what is compared with what
+INTEGRITY_CHECKS = {'pod5':'fast5 -> pod5', 'ubam':'pod5/fast5 -> ubam', 'bam':'ubam -> bam'}
+
+
+def get_raw_files(paths:list, extension:str) -> list:
+    """Файлы с расширением extension из списка файлов и папок (папки без рекурсии)"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted([os.path.join(path, f) for f in os.listdir(path) if f.endswith(extension)]))
+        elif path.endswith(extension):
+            files.append(path)
+    return files
+
+
+def has_bgzf_eof(file_path:str) -> bool:
+    """Проверяет маркер конца BGZF-файла (BAM/uBAM): без него файл обрезан"""
+    if os.path.getsize(file_path) < len(BGZF_EOF):
+        return False
+    with open(file_path, 'rb') as f:
+        f.seek(-len(BGZF_EOF), os.SEEK_END)
+        return f.read() == BGZF_EOF
+
+
+def count_fast5_reads(file_path:str) -> int:
+    """Количество прочтений в fast5 (multi-read: группы read_*, single-read: одно прочтение)"""
+    import h5py
+    with h5py.File(file_path, 'r') as f:
+        reads = len([k for k in f.keys() if k.startswith('read_')])
+    return reads or 1
+
+
+def count_pod5_reads(file_path:str) -> int:
+    """Количество прочтений в pod5. Обрезанный файл не открывается (нет footer) - будет ошибка"""
+    import pod5
+    with pod5.Reader(file_path) as reader:
+        return reader.num_reads
+
+
+def count_bam_reads(file_path:str, threads:int=1) -> int:
+    """Количество первичных записей (откартированных и нет) в BAM/uBAM, файл читается потоком samtools"""
+    stdout, stderr = run_shell_cmd(cmd=f"samtools view -c -F 0x900 -@ {threads} {file_path}")
+    if not stdout.strip().isdigit():
+        raise ValueError(f"samtools не смог прочитать {file_path}: {stderr.strip()}")
+    return int(stdout)
+
+
+def count_reads(files:list, threads:int=1) -> int:
+    """Суммарное количество прочтений в файлах fast5, pod5, BAM/uBAM"""
+    counters = {'.fast5':count_fast5_reads, '.pod5':count_pod5_reads}
+    reads = 0
+    for file_path in files:
+        extension = os.path.splitext(file_path)[1]
+        if extension in counters:
+            reads += counters[extension](file_path)
+        else:
+            reads += count_bam_reads(file_path=file_path, threads=threads)
+    return reads
+
+
+def check_integrity(check:str, inputs:list, outputs:list, min_read_ratio:float=1.0, threads:int=1) -> dict:
+    """
+    Проверка результатов стадии: выходные файлы на месте и полные (pod5 открываются, у BAM есть маркер EOF),
+    а прочтений на выходе не меньше min_read_ratio от входа
+    (при бейсколлинге прочтения могут разделяться, поэтому на выходе их может быть больше)
+
+    :param check: 'pod5', 'ubam' или 'bam' (INTEGRITY_CHECKS)
+    :param inputs: входные файлы/папки стадии
+    :param outputs: выходные файлы/папки стадии
+    :return: {'check', 'passed', 'input_reads', 'output_reads', 'errors':[...]}
+    """
+    if check not in INTEGRITY_CHECKS:
+        raise ValueError(f"Неизвестная проверка: {check}")
+    input_extensions = {'pod5':['.fast5'], 'ubam':['.pod5', '.fast5'], 'bam':['.ubam']}[check]
+    output_extension = {'pod5':'.pod5', 'ubam':'.ubam', 'bam':'.bam'}[check]
+    report = {'check':check, 'passed':False, 'input_reads':None, 'output_reads':None, 'errors':[]}
+
+    input_files = [f for extension in input_extensions for f in get_raw_files(paths=inputs, extension=extension)]
+    output_files = [f for f in get_raw_files(paths=outputs, extension=output_extension) if os.path.exists(f)]
+    missing = [f for f in outputs if not os.path.exists(f)]
+    if missing:
+        report['errors'].append(f"Не найдены: {', '.join(missing)}")
+    if not output_files:
+        report['errors'].append(f'Нет выходных файлов {output_extension}')
+    if output_extension != '.pod5':
+        report['errors'].extend([f'Файл обрезан (нет маркера EOF): {f}' for f in output_files if not has_bgzf_eof(file_path=f)])
+    if report['errors']:
+        return report
+
+    try:
+        report['input_reads'] = count_reads(files=input_files, threads=threads)
+        report['output_reads'] = count_reads(files=output_files, threads=threads)
+    except Exception as e:
+        report['errors'].append(f'Ошибка чтения: {e}')
+        return report
+    if report['output_reads'] < report['input_reads'] * min_read_ratio:
+        report['errors'].append(f"Прочтений на выходе {report['output_reads']}, на входе {report['input_reads']} "
+                                f"(допустимо не меньше {min_read_ratio:.0%})")
+    report['passed'] = not report['errors']
+    return report
+
+
+def load_integrity_report(file_path:str) -> dict:
+    """Отчёт проверки, пустой, если проверка ещё не выполнена"""
+    if not os.path.exists(file_path):
+        return {}
+    with open(file_path) as f:
+        return json.load(f)
@@ -0,0 +1,187 @@
+import os
+import gzip
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+# modkit bedmethyl columns: chrom, start, mod code, strand, Nvalid_cov, Nmod
+BEDMETHYL_USECOLS = [0, 1, 3, 5, 9, 11]
+BEDMETHYL_COLUMNS = ['chrom', 'start', 'code', 'strand', 'valid', 'mod']
+# rows per chunk of bedmethyl
+BEDMETHYL_CHUNK_SIZE = 2000000
+COVERAGE_MAX = np.iinfo(np.uint16).max
+
+
+def read_fasta(file_path:str):
+    """Генератор (имя хромосомы, последовательность в bytes) по FASTA (в том числе .gz)"""
+    opener = gzip.open if file_path.endswith('.gz') else open
+    name = None
+    lines = []
+    with opener(file_path, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if name is not None:
+                    yield (name, b''.join(lines))
+                name = line[1:].split()[0].decode()
+                lines = []
+            else:
+                lines.append(line.rstrip())
+    if name is not None:
+        yield (name, b''.join(lines))
+
+
+def find_cpg_positions(seq:bytes) -> np.ndarray:
+    """0-based позиции C всех CpG последовательности"""
+    seq = np.frombuffer(seq.upper(), dtype=np.uint8)
+    return np.flatnonzero((seq[:-1] == ord('C')) & (seq[1:] == ord('G'))).astype(np.int32)
+
+
+def build_cpg_index(ref:str) -> dict:
+    """
+    Общий для когорты индекс CpG по референсу: номер CpG = смещение хромосомы + номер CpG в хромосоме
+    :param ref: FASTA референса
+    :return: {'chroms':[...], 'offsets':[...], 'positions':позиции CpG всех хромосом подряд}
+    """
+    chroms = []
+    offsets = [0]
+    positions = []
+    for chrom, seq in read_fasta(file_path=ref):
+        chrom_positions = find_cpg_positions(seq=seq)
+        chroms.append(chrom)
+        offsets.append(offsets[-1] + len(chrom_positions))
+        positions.append(chrom_positions)
+    return {'chroms':np.array(chroms), 'offsets':np.array(offsets, dtype=np.int64),
+            'positions':np.concatenate(positions) if positions else np.array([], dtype=np.int32)}
+
+
+def load_cpg_index(file_path:str, ref:str) -> dict:
+    """Загружает индекс CpG из file_path (.npz) или строит его по референсу и сохраняет"""
+    if not os.path.exists(file_path):
+        np.savez(file_path, **build_cpg_index(ref=ref))
+    with np.load(file_path) as index:
+        return {k:index[k] for k in index.files}
+
+
+def get_region_columns(cpg_index:dict, regions:str='') -> np.ndarray:
+    """
+    Номера колонок матрицы для CpG индекса: все CpG или только попавшие в регионы BED
+    :param regions: BED с регионами (chrom, start, end), если пусто - берутся все CpG
+    :return: массив длины индекса, -1 для CpG вне регионов
+    """
+    n_cpg = len(cpg_index['positions'])
+    if not regions:
+        return np.arange(n_cpg, dtype=np.int64)
+    # +1 at first CpG of region and -1 after the last one, cumsum gives mask of covered CpGs
+    coverage = np.zeros(n_cpg + 1, dtype=np.int32)
+    bed = pd.read_csv(regions, sep='\t', header=None, usecols=[0, 1, 2], names=['chrom', 'start', 'end'],
+                      dtype={'chrom':str}, comment='#')
+    for i, chrom in enumerate(cpg_index['chroms']):
+        chrom_regions = bed[bed['chrom'] == chrom]
+        if chrom_regions.empty:
+            continue
+        offset, end = cpg_index['offsets'][i], cpg_index['offsets'][i + 1]
+        chrom_positions = cpg_index['positions'][offset:end]
+        np.add.at(coverage, offset + np.searchsorted(chrom_positions, chrom_regions['start'].values), 1)
+        np.add.at(coverage, offset + np.searchsorted(chrom_positions, chrom_regions['end'].values), -1)
+    mask = np.cumsum(coverage[:-1]) > 0
+    return np.where(mask, np.cumsum(mask) - 1, -1)
+
+
+def map_bedmethyl_to_index(chunk:pd.DataFrame, cpg_index:dict) -> tuple:
+    """
+    Сопоставляет строки bedmethyl номерам CpG индекса. Вызовы на минус-цепи (G в позиции C+1) относятся к тому же CpG.
+    Строки вне CpG референса отбрасываются
+    :return: (номера CpG, строки chunk, для которых они найдены)
+    """
+    chrom_numbers = {chrom:i for i, chrom in enumerate(cpg_index['chroms'])}
+    indices = []
+    rows = []
+    for chrom, chrom_chunk in chunk.groupby('chrom', sort=False):
+        if chrom not in chrom_numbers:
+            continue
+        i = chrom_numbers[chrom]
+        offset, end = cpg_index['offsets'][i], cpg_index['offsets'][i + 1]
+        chrom_positions = cpg_index['positions'][offset:end]
+        positions = chrom_chunk['start'].values - (chrom_chunk['strand'].values == '-')
+        idx = np.minimum(np.searchsorted(chrom_positions, positions), max(len(chrom_positions) - 1, 0))
+        found = (chrom_positions[idx] == positions) if len(chrom_positions) else np.zeros(len(positions), dtype=bool)
+        indices.append(offset + idx[found])
+        rows.append(chrom_chunk[found])
+    if not indices:
+        return (np.array([], dtype=np.int64), chunk.iloc[0:0])
+    return (np.concatenate(indices), pd.concat(rows))
+
+
+def fill_sample_row(bedmethyl:str, row:int, matrix_files:dict, cpg_index_file:str, columns_file:str,
+                    mod_code:str='m', min_coverage:int=1, chunk_size:int=BEDMETHYL_CHUNK_SIZE) -> int:
+    """
+    Читает bedmethyl образца по частям, суммирует валидные и модифицированные вызовы по CpG
+    и записывает строку образца в матрицы покрытия (uint16) и доли модифицированных (float32).
+    Каждый процесс пишет только свою строку, поэтому образцы обрабатываются параллельно.
+    Доля для CpG с покрытием меньше min_coverage - NaN
+
+    :param matrix_files: {'coverage':.npy, 'fraction':.npy}
+    :return: количество CpG образца с покрытием не меньше min_coverage
+    """
+    with np.load(cpg_index_file) as index:
+        cpg_index = {k:index[k] for k in index.files}
+    columns = np.load(columns_file)
+    n_columns = int(columns.max()) + 1 if len(columns) else 0
+    valid = np.zeros(n_columns, dtype=np.uint32)
+    mod = np.zeros(n_columns, dtype=np.uint32)
+    for chunk in pd.read_csv(bedmethyl, sep=r'\s+', header=None, usecols=BEDMETHYL_USECOLS,
+                             dtype={0:str, 3:str, 5:str}, chunksize=chunk_size):
+        chunk.columns = BEDMETHYL_COLUMNS
+        chunk = chunk[chunk['code'] == mod_code]
+        indices, rows = map_bedmethyl_to_index(chunk=chunk, cpg_index=cpg_index)
+        chunk_columns = columns[indices]
+        selected = chunk_columns >= 0
+        np.add.at(valid, chunk_columns[selected], rows['valid'].values[selected].astype(np.uint32))
+        np.add.at(mod, chunk_columns[selected], rows['mod'].values[selected].astype(np.uint32))
+
+    covered = valid >= max(min_coverage, 1)
+    coverage = np.lib.format.open_memmap(matrix_files['coverage'], mode='r+')
+    coverage[row] = np.minimum(valid, COVERAGE_MAX).astype(np.uint16)
+    coverage.flush()
+    fraction = np.lib.format.open_memmap(matrix_files['fraction'], mode='r+')
+    fraction[row] = np.where(covered, mod / np.maximum(valid, 1), np.nan).astype(np.float32)
+    fraction.flush()
+    return int(covered.sum())
+
+
+def build_methylation_matrix(bedmethyls:dict, ref:str, out_prefix:str, cpg_index_file:str='', regions:str='',
+                             mod_code:str='m', min_coverage:int=1, workers:int=1) -> dict:
+    """
+    Матрица образец x CpG для когорты в memory-mapped .npy: {out_prefix}.coverage.npy (uint16)
+    и {out_prefix}.fraction.npy (float32), колонки - CpG индекса референса (или только CpG в регионах),
+    описание строк и колонок - в {out_prefix}.index.npz (samples, chroms, offsets, positions, columns).
+    Открывать: np.load(file, mmap_mode='r')
+
+    :param bedmethyls: {sample:.bedmethyl.gz}
+    :param cpg_index_file: кэш индекса CpG референса (.npz), по умолчанию {out_prefix}.cpg_index.npz
+    :param regions: BED с регионами, CpG вне которых в матрицу не попадают
+    :param min_coverage: минимальное покрытие CpG для расчёта доли
+    :return: {sample:количество CpG с покрытием не меньше min_coverage}
+    """
+    cpg_index_file = cpg_index_file or f'{out_prefix}.cpg_index.npz'
+    cpg_index = load_cpg_index(file_path=cpg_index_file, ref=ref)
+    columns = get_region_columns(cpg_index=cpg_index, regions=regions)
+    columns_file = f'{out_prefix}.columns.npy'
+    np.save(columns_file, columns)
+    n_columns = int(columns.max()) + 1 if len(columns) else 0
+    samples = sorted(bedmethyls)
+    np.savez(f'{out_prefix}.index.npz', samples=np.array(samples), chroms=cpg_index['chroms'], offsets=cpg_index['offsets'],
+             positions=cpg_index['positions'], columns=np.flatnonzero(columns >= 0))
+    del cpg_index
+
+    matrix_files = {'coverage':f'{out_prefix}.coverage.npy', 'fraction':f'{out_prefix}.fraction.npy'}
+    np.lib.format.open_memmap(matrix_files['coverage'], mode='w+', dtype=np.uint16, shape=(len(samples), n_columns)).flush()
+    np.lib.format.open_memmap(matrix_files['fraction'], mode='w+', dtype=np.float32, shape=(len(samples), n_columns)).flush()
+
+    with ProcessPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = {sample:executor.submit(fill_sample_row, bedmethyls[sample], row, matrix_files, cpg_index_file, columns_file,
+                                          mod_code, min_coverage)
+                   for row, sample in enumerate(samples)}
+        covered = {sample:future.result() for sample, future in futures.items()}
+    os.remove(columns_file)
+    return covered
@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import datetime
+from contextlib import contextmanager
+
+SLURM_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# states after which accounting data of job won't change anymore
+FINAL_JOB_STATES = ['COMPLETED', 'FAILED', 'TIMEOUT', 'OUT_OF_MEMORY', 'CANCELLED', 'NODE_FAIL', 'PREEMPTED', 'BOOT_FAIL', 'DEADLINE']
+METRIC_PREFIX = 'nanopore'
+
+
+def parse_slurm_time(value:str):
+    """Преобразует время из sacct в datetime. Для 'Unknown', 'None' и пустых значений возвращает None"""
+    try:
+        return datetime.datetime.strptime(value, SLURM_TIME_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_paths_size(paths:list) -> int:
+    """
+    Возвращает суммарный размер файлов и папок в байтах.
+    В отличие от get_dir_size, символические ссылки учитываются (pod5 из MinKNOW подключаются ссылками)
+    """
+    total_size = 0
+    for path in paths:
+        if os.path.isfile(path):
+            total_size += os.path.getsize(path)
+        elif os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                for f in filenames:
+                    fp = os.path.join(dirpath, f)
+                    if os.path.exists(fp):
+                        total_size += os.path.getsize(fp)
+    return total_size
+
+
+def build_job_metrics(accounting:dict, input_bytes:int=0, input_reads:int=None, retries:int=0) -> dict:
+    """
+    Считает метрики одной задачи по данным sacct.
+    :param accounting: запись задачи из get_slurm_job_accounting
+    :param input_bytes: размер входных данных задачи
+    :param input_reads: количество прочтений на входе, если известно
+    :param retries: количество повторных запусков задачи (перезапуски Slurm учитываются отдельно)
+    :return: {'state', 'queue_wait_seconds', 'run_seconds', 'input_bytes', 'input_reads',
+              'bytes_per_second', 'reads_per_second', 'retries', 'nodes'}
+    """
+    submit = parse_slurm_time(accounting.get('submit'))
+    start = parse_slurm_time(accounting.get('start'))
+    end = parse_slurm_time(accounting.get('end'))
+
+    queue_wait = (start - submit).total_seconds() if submit and start else None
+    run_time = (end - start).total_seconds() if start and end else None
+    # throughput has sense only for finished jobs with non-zero run time
+    bytes_per_second = input_bytes / run_time if run_time and input_bytes else None
+    reads_per_second = input_reads / run_time if run_time and input_reads else None
+
+    return {'state':accounting.get('state', 'UNKNOWN_STATE'),
+            'queue_wait_seconds':queue_wait,
+            'run_seconds':run_time,
+            'input_bytes':input_bytes,
+            'input_reads':input_reads,
+            'bytes_per_second':bytes_per_second,
+            'reads_per_second':reads_per_second,
+            'retries':retries + accounting.get('requeues', 0),
+            'nodes':accounting.get('nodes', ''),
+            'start':accounting.get('start'),
+            'end':accounting.get('end')}
+
+
+def summarize_stage_metrics(jobs_metrics:dict) -> dict:
+    """
+    Сводит метрики задач одной стадии образца.
+    Задачи стадии идут параллельно, поэтому ожидание в очереди - максимальное по задачам,
+    а время работы - от первого старта до последнего завершения.
+    :param jobs_metrics: {job_id:метрики из build_job_metrics}
+    :return: метрики стадии
+    """
+    jobs = list(jobs_metrics.values())
+    queue_waits = [j['queue_wait_seconds'] for j in jobs if j['queue_wait_seconds'] is not None]
+    starts = [parse_slurm_time(j['start']) for j in jobs]
+    ends = [parse_slurm_time(j['end']) for j in jobs]
+    starts = [t for t in starts if t]
+    ends = [t for t in ends if t]
+    # wall time is known only when all jobs of stage are finished
+    run_time = (max(ends) - min(starts)).total_seconds() if starts and len(ends) == len(jobs) else None
+    input_bytes = sum([j['input_bytes'] for j in jobs])
+    reads = [j['input_reads'] for j in jobs if j['input_reads'] is not None]
+    input_reads = sum(reads) if reads else None
+
+    return {'jobs':len(jobs),
+            'states':sorted(set([j['state'] for j in jobs])),
+            'queue_wait_seconds':max(queue_waits) if queue_waits else None,
+            'run_seconds':run_time,
+            'input_bytes':input_bytes,
+            'input_reads':input_reads,
+            'bytes_per_second':input_bytes / run_time if run_time and input_bytes else None,
+            'reads_per_second':input_reads / run_time if run_time and input_reads else None,
+            'retries':sum([j['retries'] for j in jobs])}
+
+
+@contextmanager
+def timing_span(spans:dict, name:str):
+    """
+    Замеряет время выполнения блока кода и накапливает его в spans.
+    Usage: with timing_span(spans, 'polling'): ...
+    :param spans: {name:{'calls':n, 'seconds':t, 'last_seconds':t}}
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = time.monotonic() - start
+        span = spans.setdefault(name, {'calls':0, 'seconds':0.0, 'last_seconds':0.0})
+        span['calls'] += 1
+        span['seconds'] += elapsed
+        span['last_seconds'] = elapsed
+
+
+def format_prometheus_metrics(stage_metrics:dict, spans:dict) -> str:
+    """
+    Формирует метрики в текстовом формате Prometheus (для textfile collector node_exporter).
+    :param stage_metrics: {sample:{stage:метрики из summarize_stage_metrics}}
+    :param spans: замеры фаз оркестратора из timing_span
+    """
+    stage_fields = {'queue_wait_seconds':('gauge', 'Max time from submit to start among stage jobs'),
+                    'run_seconds':('gauge', 'Wall time from first start to last end of stage jobs'),
+                    'input_bytes':('gauge', 'Size of stage input data'),
+                    'bytes_per_second':('gauge', 'Stage throughput in bytes per second'),
+                    'reads_per_second':('gauge', 'Stage throughput in reads per second'),
+                    'retries':('counter', 'Retries of stage jobs')}
+    lines = []
+    for field, (metric_type, help_str) in stage_fields.items():
+        metric = f'{METRIC_PREFIX}_stage_{field}' if field != 'retries' else f'{METRIC_PREFIX}_stage_retries_total'
+        lines.append(f'# HELP {metric} {help_str}')
+        lines.append(f'# TYPE {metric} {metric_type}')
+        for sample, stages in stage_metrics.items():
+            for stage, metrics in stages.items():
+                if metrics.get(field) is not None:
+                    lines.append(f'{metric}{{sample="{sample}",stage="{stage}"}} {metrics[field]}')
+
+    for field, metric_type, help_str in [('seconds', 'counter', 'Total time spent by orchestrator in phase'),
+                                         ('calls', 'counter', 'Number of orchestrator phase runs'),
+                                         ('last_seconds', 'gauge', 'Duration of last orchestrator phase run')]:
+        metric = f'{METRIC_PREFIX}_orchestrator_phase_{field}'
+        metric = f'{metric}_total' if metric_type == 'counter' else metric
+        lines.append(f'# HELP {metric} {help_str}')
+        lines.append(f'# TYPE {metric} {metric_type}')
+        for phase, span in spans.items():
+            lines.append(f'{metric}{{phase="{phase}"}} {span[field]}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus_textfile(file_path:str, stage_metrics:dict, spans:dict) -> None:
+    """
+    Записывает метрики в формате Prometheus.
+    Файл пишется через временный и переименовывается, чтобы collector не прочитал его недописанным
+    """
+    tmp_path = f'{file_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(format_prometheus_metrics(stage_metrics=stage_metrics, spans=spans))
+    os.replace(tmp_path, file_path)
+
+
+def write_sample_summary(file_path:str, sample:str, stage_metrics:dict, jobs_metrics:dict) -> None:
+    """
+    Записывает JSON-сводку метрик образца.
+    :param stage_metrics: {stage:метрики стадии}
+    :param jobs_metrics: {stage:{job_id:метрики задачи}}
+    """
+    summary = {'sample':sample,
+               'updated':datetime.datetime.now().strftime(SLURM_TIME_FORMAT),
+               'stages':{stage:{**metrics, 'jobs_metrics':jobs_metrics.get(stage, {})}
+                         for stage, metrics in stage_metrics.items()}}
+    tmp_path = f'{file_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(summary, f, indent=4)
+    os.replace(tmp_path, file_path)
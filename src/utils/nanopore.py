@@ -1,31 +1,85 @@
 import os
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils.slurm import submit_slurm_job
+from utils.slurm import submit_slurm_job, submit_slurm_jobs
 
 dorado_bin = '/home/PAK-CSPMZ/kbajbekov/programms/dorado-0.8.3-linux-x64/bin/dorado'
+check_integrity_script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'check_integrity.py')
 
 
-def get_fast5_dirs(dir:str) -> list:
+def get_raw_data_dirs(dir:str, extension:str, dir_names:tuple) -> list:
     """
-    Генерирует список подпапок, содержащих fast5 и именованных 'fast5_pass'.
-    Выдаёт ошибку, если итоговый список пустой.
+    Генерирует список подпапок образца, содержащих файлы с расширением extension
+    и именованных одним из dir_names (например, 'fast5_pass' или 'pod5_pass').
 
-    :param dir: Директория, где искать файлы.
+    :param dir: Директория образца, где искать папки.
+    :param extension: Расширение файлов сырого сигнала ('.fast5', '.pod5').
+    :param dir_names: Допустимые имена папок с сырыми данными.
     :return: Список папок.
     """
     subdirs = [os.path.join(dir, s) for s in os.listdir(dir) if os.path.isdir(os.path.join(dir, s, os.sep))]
-    fast5s = []
+    raw_dirs = []
     for subdir in subdirs:
         
         for root, _ds, fs in os.walk(subdir):
             for f in fs:
-                if f.endswith('.fast5') and os.path.basename(root) == 'fast5_pass':
-                    fast5s.append(f'{os.path.join(root)}{os.sep}')
+                if f.endswith(extension) and os.path.basename(root) in dir_names:
+                    raw_dirs.append(f'{os.path.join(root)}{os.sep}')
+
+    return list(set(raw_dirs))
+
+def get_fast5_dirs(dir:str) -> list:
+    """
+    Генерирует список подпапок, содержащих fast5 и именованных 'fast5_pass'.
+
+    :param dir: Директория, где искать файлы.
+    :return: Список папок.
+    """
+    return get_raw_data_dirs(dir=dir, extension='.fast5', dir_names=('fast5_pass',))
+
+def get_pod5_dirs(dir:str) -> list:
+    """
+    Генерирует список подпапок, содержащих pod5 и именованных 'pod5_pass' или 'pod5'
+    (новые версии MinKNOW пишут pod5 сразу, конвертация для таких запусков не нужна).
+
+    :param dir: Директория, где искать файлы.
+    :return: Список папок.
+    """
+    return get_raw_data_dirs(dir=dir, extension='.pod5', dir_names=('pod5_pass', 'pod5'))
 
-    return list(set(fast5s))
+def link_raw_files(raw_dirs:list, sample:str, out_dir:str, extension:str='.pod5') -> str:
+    """
+    Создаёт в папке образца внутри out_dir символические ссылки на уже существующие файлы сырого сигнала
+    (.pod5 из MinKNOW или .fast5, если они не конвертируются), чтобы бейсколлинг читал их напрямую,
+    без копирования и повторной записи сигнала.
+    К имени ссылки добавляется имя папки запуска, чтобы файлы разных проточных ячеек не перезаписали друг друга.
 
-def convert_fast5_to_pod5(fast5_dirs:list, sample:str, out_dir:str, threads:str, mem:int, exclude_nodes:list=[], working_dir:str='') ->list :
+    :param raw_dirs: папки с исходными файлами
+    :param sample: наименование образца
+    :param out_dir: папка для pod5 (pod5_dir)
+    :param extension: расширение файлов ('.pod5', '.fast5')
+    :return: папка образца со ссылками
+    """
+    pod5_dir = f'{os.path.join(out_dir, sample)}{os.sep}'
+    os.makedirs(pod5_dir, exist_ok=True)
+
+    for src_dir in raw_dirs:
+        run_name = os.path.basename(os.path.dirname(os.path.normpath(src_dir)))
+        for f in os.listdir(src_dir):
+            if not f.endswith(extension):
+                continue
+            link = os.path.join(pod5_dir, f'{run_name}_{f}')
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(os.path.abspath(os.path.join(src_dir, f)), link)
+    return pod5_dir
+
+def get_converted_pod5(fast5_dir:str, sample:str, out_dir:str) -> str:
+    """pod5, в который конвертируется папка fast5 образца (называется по папке запуска)"""
+    return f"{os.path.join(out_dir, sample)}{os.sep}{sample}_{os.path.basename(os.path.dirname(os.path.normpath(fast5_dir)))}.pod5"
+
+def convert_fast5_to_pod5(fast5_dirs:list, sample:str, out_dir:str, threads:str, mem:int, exclude_nodes:list=[], working_dir:str='',
+                          partition:str='cpu_nodes') ->list :
     """
     Запуск задачи конвертации fast5 -> pod5 на CPU. Задача выполняется на одной ЦПУ ноде
     :param fast5_dirs: папки с файлами для конвертации
@@ -33,25 +87,30 @@ def convert_fast5_to_pod5(fast5_dirs:list, sample:str, out_dir:str, threads:str,
     :param out_dir: папка для результатов
     :param threads: количество потоков на задачу
     :param ntasks: количество задач на машину
+    :param partition: раздел Slurm
     :return: список id задач Slurm для образца
     """
-    job_ids = []
-    pod5_dir = f'{os.path.join(out_dir, sample)}{os.sep}'
-    
+    jobs = []
+
     for fast5_dir in fast5_dirs:
         #print('fast5_dir',fast5_dir)
         # pod5 will be named as parent dir for fast5 files
-        pod5_name = f'{sample}_{os.path.basename(os.path.dirname(os.path.normpath(fast5_dir)))}'
+        pod5 = get_converted_pod5(fast5_dir=fast5_dir, sample=sample, out_dir=out_dir)
+        pod5_name = os.path.splitext(os.path.basename(pod5))[0]
 
-        command = f"pod5 convert fast5 {fast5_dir}*.fast5 --output {pod5_dir}/{pod5_name}.pod5 --threads {threads}"
-        job_id = submit_slurm_job(command, partition="cpu_nodes",
-                                  job_name=f"pod5_convert_{sample}_{pod5_name}",
-                                  nodes=1, cpus_per_task=threads, mem=mem, exclude_nodes=exclude_nodes, working_dir=working_dir)
-        job_ids.append(job_id)
-    return job_ids
+        command = f"pod5 convert fast5 {fast5_dir}*.fast5 --output {pod5} --threads {threads}"
+        jobs.append({'command':command, 'partition':partition,
+                     'job_name':f"pod5_convert_{sample}_{pod5_name}",
+                     'nodes':1, 'cpus_per_task':threads, 'mem':mem, 'exclude_nodes':exclude_nodes, 'working_dir':working_dir})
+    # all conversion jobs of sample are submitted in one batch
+    return submit_slurm_jobs(jobs=jobs)
 
-def basecalling(sample:str, in_dir:str, out_dir:str, mod_type:str, model:str, mem:int, threads:int, dependency:list, working_dir:str='') -> tuple:
-    """Запуск бейсколлинга на GPU"""
+def basecalling(sample:str, in_dir:str, out_dir:str, mod_type:str, model:str, mem:int, threads:int,
+                working_dir:str='', partition:str='gpu_nodes', exclude_nodes:list=[]) -> tuple:
+    """
+    Запуск бейсколлинга на GPU.
+    dorado читает папку образца в in_dir: pod5 или ссылки на fast5 (dorado 0.8.3 читает fast5 без конвертации)
+    """
 
     pod5_dir = f'{os.path.join(in_dir,sample)}{os.sep}'
     ubam_dir = f'{os.path.join(out_dir,sample)}{os.sep}'
@@ -59,32 +118,50 @@ def basecalling(sample:str, in_dir:str, out_dir:str, mod_type:str, model:str, me
     ubam = f"{ubam_dir}{sample}_{mod_type.replace('_', '-')}.ubam"
 
     command = f"{dorado_bin} basecaller {model} {pod5_dir} --batchsize 2048 --modified-bases {mod_type} > {ubam}"
-    return (submit_slurm_job(command, partition="gpu_nodes", nodes=1, job_name=f"basecall_{sample}_{mod_type}", mem=mem, cpus_per_task=threads, dependency=dependency, working_dir=working_dir),
+    return (submit_slurm_job(command, partition=partition, nodes=1, job_name=f"basecall_{sample}_{mod_type}", mem=mem, cpus_per_task=threads,
+                             exclude_nodes=exclude_nodes, working_dir=working_dir),
              ubam)
 
-def aligning(sample:str, ubam:str, out_dir:str, mod_type:str, ref:str, threads:str, mem:int, dependency:list, exclude_nodes:list=[], working_dir:str=''):
+def aligning(sample:str, ubam:str, out_dir:str, mod_type:str, ref:str, threads:str, mem:int, exclude_nodes:list=[], working_dir:str='',
+             partition:str='cpu_nodes'):
     """Запуск выравнивания на CPU нодах"""
     bam_dir = f'{os.path.join(out_dir,sample,mod_type)}{os.sep}'
     bam = ubam.replace(os.path.dirname(ubam), bam_dir).replace('.ubam', '.sorted.aligned.bam')
     command = f"nextflow run epi2me-labs/wf-alignment --bam {ubam} --out_dir {bam_dir} --references {ref} --threads {threads}"
-    return (submit_slurm_job(command, partition="cpu_nodes", nodes=1, cpus_per_task=threads,
+    return (submit_slurm_job(command, partition=partition, nodes=1, cpus_per_task=threads,
                             job_name=f"align_{sample}_{mod_type}", mem=mem,
-                            dependency=dependency, exclude_nodes=exclude_nodes, working_dir=working_dir),
+                            exclude_nodes=exclude_nodes, working_dir=working_dir),
                              bam)
 
-def modifications_lookup(sample:str, bam:str, out_dir:str, mod_type:str, model:str, ref:str, threads:str, mem:int, dependency:list, exclude_nodes:list=[], working_dir:str=''):
+def modifications_lookup(sample:str, bam:str, out_dir:str, mod_type:str, model:str, ref:str, threads:str, mem:int, exclude_nodes:list=[], working_dir:str='',
+                         partition:str='cpu_nodes'):
     """Запуск выравнивания на CPU нодах"""
     
     command = f"nextflow run epi2me-labs/wf-human-variation --bam {bam} --ref {ref} --mod --threads {threads} --out_dir {out_dir} --sample_name {sample}_ --override_basecaller_cfg {model} --force_strand"
-    return submit_slurm_job(command, partition="cpu_nodes", nodes=1, cpus_per_task=threads,
+    return submit_slurm_job(command, partition=partition, nodes=1, cpus_per_task=threads,
                             job_name=f"modkit_{sample}_{mod_type}", mem=mem,
-                            dependency=dependency, exclude_nodes=exclude_nodes, working_dir=working_dir)
+                            exclude_nodes=exclude_nodes, working_dir=working_dir)
 
 def sv_lookup(sample:str, bam:str, out_dir:str, mod_type:str, tr_bed:str, model:str, ref:str, mem:int,
-              threads:str, dependency:list, exclude_nodes:list=[], working_dir:str=''):
+              threads:str, exclude_nodes:list=[], working_dir:str='', partition:str='cpu_nodes'):
     """Запуск выравнивания на CPU нодах"""
     
     command = f"nextflow run epi2me-labs/wf-human-variation --bam {bam} --ref {ref} --snp --cnv --str --sv --phased --tr_bed {tr_bed} --threads {threads} --out_dir {out_dir} --sample_name {sample}_ --override_basecaller_cfg {model} --force_strand"
-    return submit_slurm_job(command, partition="cpu_nodes", nodes=1, cpus_per_task=threads,
+    return submit_slurm_job(command, partition=partition, nodes=1, cpus_per_task=threads,
                             job_name=f"sv_{sample}_{mod_type}", mem=mem,
-                            dependency=dependency, exclude_nodes=exclude_nodes, working_dir=working_dir)
\ No newline at end of file
+                            exclude_nodes=exclude_nodes, working_dir=working_dir)
+
+
+def integrity_check(sample:str, check:str, inputs:list, outputs:list, report:str, key:str, threads:str, mem:int,
+                    min_read_ratio:float=1.0, exclude_nodes:list=[], working_dir:str='', partition:str='cpu_nodes'):
+    """
+    Запуск проверки целостности результатов стадии на CPU нодах (check_integrity.py)
+    :param check: 'pod5', 'ubam' или 'bam'
+    :param report: JSON-отчёт проверки
+    :param key: узел пайплайна, результаты которого проверяются (для имени задачи)
+    """
+    command = f"python3 {check_integrity_script} --check {check} --inputs {' '.join(inputs)} --outputs {' '.join(outputs)} " \
+              f"--report {report} --min_read_ratio {min_read_ratio} --threads {threads}"
+    return submit_slurm_job(command, partition=partition, nodes=1, cpus_per_task=threads,
+                            job_name=f"check_{sample}_{key.replace(':', '_')}", mem=mem,
+                            exclude_nodes=exclude_nodes, working_dir=working_dir)
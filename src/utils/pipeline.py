@@ -0,0 +1,275 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.common import load_yaml
+
+
+def load_pipeline(file_path:str) -> dict:
+    """
+    Загружает описание пайплайна (стадии, классы ресурсов, размножение стадий, зависимости) и проверяет его.
+    Стадии возвращаются в топологическом порядке.
+
+    :param file_path: путь к YAML с описанием пайплайна
+    :return: словарь описания пайплайна
+    """
+    pipeline = load_yaml(file_path=file_path, critical=True)
+    for section in ['resource_classes', 'stages']:
+        if not pipeline.get(section):
+            raise ValueError(f"Раздел '{section}' не найден в {file_path}")
+    pipeline.setdefault('fan_out', {})
+
+    for stage, stage_data in pipeline['stages'].items():
+        stage_data.setdefault('depends_on', [])
+        stage_data.setdefault('fan_out', '')
+        stage_data.setdefault('function', stage)
+        if stage_data.get('resource_class') not in pipeline['resource_classes']:
+            raise ValueError(f"Стадия '{stage}': неизвестный класс ресурсов '{stage_data.get('resource_class')}'")
+        if stage_data['fan_out'] and stage_data['fan_out'] not in pipeline['fan_out']:
+            raise ValueError(f"Стадия '{stage}': неизвестный ключ размножения '{stage_data['fan_out']}'")
+        for upstream in stage_data['depends_on']:
+            if upstream not in pipeline['stages']:
+                raise ValueError(f"Стадия '{stage}' зависит от неизвестной стадии '{upstream}'")
+
+        if stage_data.get('window', 1) < 1:
+            raise ValueError(f"Стадия '{stage}': window должен быть больше 0")
+
+    pipeline['stages'] = {stage:pipeline['stages'][stage] for stage in sort_stages(stages=pipeline['stages'])}
+    return pipeline
+
+
+def sort_stages(stages:dict) -> list:
+    """
+    Топологическая сортировка стадий (алгоритм Кана). Порядок независимых стадий сохраняется как в описании.
+    :param stages: {stage:{'depends_on':[stages]}}
+    :return: список стадий
+    """
+    remaining = {stage:set(data.get('depends_on', [])) for stage, data in stages.items()}
+    ordered = []
+    while remaining:
+        ready = [stage for stage, upstream in remaining.items() if not upstream]
+        if not ready:
+            raise ValueError(f"Циклическая зависимость между стадиями: {', '.join(remaining)}")
+        for stage in ready:
+            ordered.append(stage)
+            del remaining[stage]
+        for upstream in remaining.values():
+            upstream.difference_update(ready)
+    return ordered
+
+
+def get_stage_threads(stage_data:dict, threads_per_machine:int) -> int:
+    """
+    Количество потоков на задачу стадии: либо фиксированное (threads),
+    либо доля машины при tasks_per_machine параллельных задачах, но не больше max_threads
+    """
+    if 'threads' in stage_data:
+        return int(stage_data['threads'])
+    threads = int(threads_per_machine) // int(stage_data.get('tasks_per_machine', 1))
+    return max(min(threads, int(stage_data.get('max_threads', threads))), 1)
+
+
+def expand_pipeline(pipeline:dict, skip_stages:list=[]) -> list:
+    """
+    Разворачивает описание пайплайна в список узлов для одного образца в топологическом порядке.
+    Стадия с fan_out размножается по значениям ключа (например, по типам модификаций);
+    размноженная стадия зависит от узла вышестоящей стадии с тем же значением, если та тоже размножена,
+    иначе - от всех её узлов. Пропущенные стадии удаляются, их потомки наследуют их зависимости.
+
+    :param pipeline: результат load_pipeline
+    :param skip_stages: стадии, которые для образца не нужны (например, конвертация при наличии pod5)
+    :return: [{'key', 'stage', 'function', 'fan_out_value', 'resource_class', 'single_run', 'depends_on':[keys]}]
+    """
+    stages = pipeline['stages']
+    nodes = []
+    # stage -> {fan_out_value:[keys of nodes, which replace it]}
+    stage_nodes = {}
+    for stage, stage_data in stages.items():
+        fan_out_values = pipeline['fan_out'][stage_data['fan_out']] if stage_data['fan_out'] else [None]
+        stage_nodes[stage] = {}
+        for value in fan_out_values:
+            depends_on = []
+            for upstream in stage_data['depends_on']:
+                upstream_nodes = stage_nodes[upstream]
+                keys = upstream_nodes[value] if value in upstream_nodes else [k for ks in upstream_nodes.values() for k in ks]
+                depends_on.extend([k for k in keys if k not in depends_on])
+
+            if stage in skip_stages:
+                # skipped node is replaced by its dependencies
+                stage_nodes[stage][value] = depends_on
+                continue
+            key = stage if value is None else f'{stage}:{value}'
+            stage_nodes[stage][value] = [key]
+            nodes.append({'key':key,
+                          'stage':stage,
+                          'function':stage_data['function'],
+                          'fan_out_value':value,
+                          'resource_class':stage_data['resource_class'],
+                          'single_run':bool(stage_data.get('single_run')),
+                          'depends_on':depends_on})
+    return nodes
+
+
+# states of pipeline nodes, for which no more jobs will be submitted
+FINAL_NODE_STATES = ['completed', 'failed', 'skipped']
+# Slurm states of jobs, which are still in queue
+ACTIVE_JOB_STATES = ['', 'PENDING', 'RUNNING', 'CONFIGURING', 'COMPLETING', 'SUSPENDED', 'REQUEUED', 'RESIZING']
+
+
+def init_sample_nodes(nodes:list) -> dict:
+    """
+    Состояние узлов образца для поэтапной отправки
+    :param nodes: результат expand_pipeline
+    :return: {key:{**node, 'state':'waiting', 'job_ids':[], 'outputs':{}}}
+    """
+    return {node['key']:{**node, 'state':'waiting', 'job_ids':[], 'outputs':{}} for node in nodes}
+
+
+def get_ready_nodes(sample_nodes:dict) -> list:
+    """Ожидающие узлы образца, все узлы-предшественники которых завершены"""
+    return [node for node in sample_nodes.values() if node['state'] == 'waiting'
+            and all([sample_nodes[key]['state'] == 'completed' for key in node['depends_on']])]
+
+
+def update_sample_nodes(sample_nodes:dict, job_results:dict, pipeline:dict) -> dict:
+    """
+    Обновляет состояния узлов образца по состояниям их задач.
+    Узел завершён, если завершены все его задачи, и упал, если хотя бы одна задача покинула очередь не завершившись
+    (перезапущенные задачи заменяются в job_ids узла). Узлы, зависящие от упавших, тоже помечаются упавшими.
+    Для стадий с single_run после отправки одного узла остальные узлы стадии пропускаются, как и зависящие от них.
+
+    :param sample_nodes: результат init_sample_nodes
+    :param job_results: {stage:{job_id:job_state}} образца
+    :return: sample_nodes
+    """
+    for node in sample_nodes.values():
+        if node['state'] != 'submitted':
+            continue
+        job_states = [job_results.get(node['stage'], {}).get(job, '') for job in node['job_ids']]
+        if all([job_state == 'COMPLETED' for job_state in job_states]):
+            node['state'] = 'completed'
+        elif any([job_state not in ACTIVE_JOB_STATES + ['COMPLETED'] for job_state in job_states]):
+            node['state'] = 'failed'
+
+    # nodes are in topological order, so state of upstream node is already final
+    for node in sample_nodes.values():
+        if node['state'] != 'waiting':
+            continue
+        upstream_states = [sample_nodes[key]['state'] for key in node['depends_on']]
+        if 'failed' in upstream_states:
+            node['state'] = 'failed'
+        elif 'skipped' in upstream_states:
+            node['state'] = 'skipped'
+        elif pipeline['stages'][node['stage']].get('single_run') and \
+                any([n['state'] in ['submitted', 'completed'] for n in sample_nodes.values() if n['stage'] == node['stage']]):
+            node['state'] = 'skipped'
+    return sample_nodes
+
+
+def stop_unchecked_nodes(sample_nodes:dict, pipeline:dict) -> list:
+    """
+    Проверки целостности (стадии с check) выполняются параллельно со стадиями после проверенного узла.
+    Если проверка упала (check_integrity.py завершается с кодом 3), узлы, зависящие от проверенного узла,
+    помечаются упавшими, и задачи отправленных узлов нужно отменить.
+
+    :param sample_nodes: результат init_sample_nodes
+    :return: id задач, которые нужно отменить
+    """
+    jobs_to_cancel = []
+    for check_node in sample_nodes.values():
+        if check_node['state'] != 'failed' or not pipeline['stages'][check_node['stage']].get('check'):
+            continue
+        # check depends only on checked node, nodes are in topological order
+        unchecked = set(check_node['depends_on'])
+        for node in sample_nodes.values():
+            if not unchecked.intersection(node['depends_on']):
+                continue
+            unchecked.add(node['key'])
+            if node['state'] == 'submitted':
+                jobs_to_cancel.extend(node['job_ids'])
+            if node['state'] in ['waiting', 'submitted', 'completed']:
+                node['state'] = 'failed'
+    return jobs_to_cancel
+
+
+def is_sample_finished(sample_nodes:dict) -> bool:
+    """Проверяет, что для образца больше нечего отправлять и ждать"""
+    return all([node['state'] in FINAL_NODE_STATES for node in sample_nodes.values()])
+
+
+def submit_pipeline_node(node:dict, sample_nodes:dict, stage_builders:dict, sample_data:dict) -> dict:
+    """
+    Отправляет узел образца в Slurm, передавая ему выходные файлы узлов, от которых он зависит.
+    Узлы-предшественники к этому моменту завершены, поэтому зависимости Slurm не нужны.
+    Остальные узлы стадии с single_run сразу пропускаются, чтобы за один проход их не отправили тоже.
+
+    :param node: узел из sample_nodes, готовый к отправке (get_ready_nodes)
+    :param stage_builders: {function:f(node, sample_data, upstream_outputs) -> (job_ids, outputs, inputs)},
+                           inputs - {job_id:[входные файлы задачи]}
+    :param sample_data: данные образца, передаются в функции стадий
+    :return: inputs задач узла
+    """
+    upstream_outputs = {}
+    for key in node['depends_on']:
+        upstream_outputs.update(sample_nodes[key]['outputs'])
+    if node['function'] not in stage_builders:
+        raise ValueError(f"Не найдена функция стадии '{node['function']}'")
+    job_ids, outputs, inputs = stage_builders[node['function']](node=node, sample_data=sample_data, upstream_outputs=upstream_outputs)
+    node.update({'state':'submitted', 'job_ids':job_ids, 'outputs':outputs})
+    if node['single_run']:
+        for sibling in sample_nodes.values():
+            if sibling['stage'] == node['stage'] and sibling['state'] == 'waiting':
+                sibling['state'] = 'skipped'
+    return inputs
+
+
+def get_stage_occupancy(cohorts:list) -> dict:
+    """
+    Образцы, узлы которых отправлены и ещё не завершены, для каждой стадии
+    :param cohorts: [{'name', 'sample_nodes':{sample:sample_nodes}}]
+    :return: {stage:set(("cohort", "sample"))}
+    """
+    occupancy = {}
+    for cohort in cohorts:
+        for sample, sample_nodes in cohort['sample_nodes'].items():
+            for node in sample_nodes.values():
+                if node['state'] == 'submitted':
+                    occupancy.setdefault(node['stage'], set()).add((cohort['name'], sample))
+    return occupancy
+
+
+def get_weighted_usage(cohort:dict, pipeline:dict) -> float:
+    """
+    Доля ресурсов кластера, занятая когортой, с учётом её веса:
+    сумма по стадиям с окном (образцы когорты в стадии / window стадии), делённая на вес
+    """
+    occupancy = get_stage_occupancy(cohorts=[cohort])
+    usage = sum([len(occupancy.get(stage, [])) / stage_data['window']
+                 for stage, stage_data in pipeline['stages'].items() if stage_data.get('window')])
+    return usage / cohort['weight']
+
+
+def choose_next_node(cohorts:list, pipeline:dict):
+    """
+    Выбирает следующий узел для отправки. Окна стадий (window - сколько образцов одновременно
+    могут быть в стадии) общие для всех когорт. Когорты рассматриваются по взвешенному справедливому распределению:
+    сначала с большим приоритетом, среди равных - с меньшей занятой долей ресурсов на единицу веса, затем принятые раньше.
+    Внутри когорты образцы, уже находящиеся в обработке, идут раньше новых, чтобы конвейер не простаивал.
+    Если окна стадий для узлов приоритетной когорты заняты, узел может получить когорта, которой нужны свободные стадии.
+
+    :param cohorts: [{'name', 'priority', 'weight', 'accepted', 'samples':[ещё не начатые образцы], 'sample_nodes'}]
+    :return: (cohort, sample, node) или None, если отправить нечего или окна заняты
+    """
+    occupancy = get_stage_occupancy(cohorts=cohorts)
+    candidates = sorted(cohorts, key=lambda cohort: (-cohort['priority'],
+                                                     get_weighted_usage(cohort=cohort, pipeline=pipeline),
+                                                     cohort['accepted']))
+    for cohort in candidates:
+        samples = sorted(cohort['sample_nodes'], key=lambda sample: sample in cohort['samples'])
+        for sample in samples:
+            for node in get_ready_nodes(sample_nodes=cohort['sample_nodes'][sample]):
+                in_stage = occupancy.get(node['stage'], set())
+                window = pipeline['stages'][node['stage']].get('window', float('inf'))
+                # other fan-out nodes of sample don't take one more place in stage
+                if (cohort['name'], sample) in in_stage or len(in_stage) < window:
+                    return (cohort, sample, node)
+    return None
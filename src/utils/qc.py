@@ -0,0 +1,193 @@
+import os
+import sys
+import json
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.common import get_samples_in_dir_tree
+
+# QC files of wf-alignment/wf-human-variation and only columns, which are needed for aggregates
+QC_FILES = {'readstats':{'extension':'.readstats.tsv.gz', 'usecols':['read_length', 'mean_quality']},
+            'flagstats':{'extension':'.flagstats.tsv', 'usecols':['ref', 'primary', 'secondary', 'supplementary', 'unmapped']},
+            'mosdepth':{'extension':'.mosdepth.summary.txt', 'usecols':['chrom', 'mean']},
+            # modkit bedmethyl has no header: mod code, Nvalid_cov, Nmod, Ncanonical
+            'bedmethyl':{'extension':'.bedmethyl.gz', 'usecols':[3, 9, 11, 12]}}
+# rows per chunk for multi-GB readstats and bedmethyl files
+QC_CHUNK_SIZE = 1000000
+
+
+def get_qc_mod_type(file_path:str, mod_types:list) -> str:
+    """
+    Тип модификаций QC-файла по папке, в которой он лежит (результаты стадий пишутся в папки {mod_type}/),
+    пустая строка, если папки типа модификаций в пути нет
+    """
+    dirs = os.path.dirname(os.path.abspath(file_path)).split(os.sep)
+    return next((d for d in reversed(dirs) if d in mod_types), '')
+
+
+def get_qc_sample_name(file_path:str, mod_type:str='') -> str:
+    """
+    Имя образца по имени QC-файла: часть до первой точки без завершающего '_'
+    (wf-human-variation запускается с --sample_name {sample}_) и без суффикса типа модификаций
+    (файлы выравнивания называются по uBAM: {sample}_{mod-type})
+    """
+    name = os.path.basename(file_path).split('.')[0].rstrip('_')
+    for suffix in [f"_{mod_type}", f"_{mod_type.replace('_', '-')}"]:
+        if mod_type and name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def find_qc_files(dir:str, mod_types:list=[]) -> dict:
+    """
+    Ищет QC-файлы в дереве папок dir. Файлы разных типов модификаций (fan_out mod_type пайплайна) не смешиваются,
+    если для образца и типа модификаций найдено несколько файлов одного вида (перезапуск), берётся самый новый
+    :param mod_types: типы модификаций пайплайна
+    :return: {sample:{mod_type:{kind:file_path}}}, mod_type - пустая строка для файлов вне папок типов модификаций
+    """
+    qc_files = {}
+    extensions = tuple([kind_data['extension'] for kind_data in QC_FILES.values()])
+    for file_path in sorted(get_samples_in_dir_tree(dir=dir, extensions=extensions, empty_ok=True), key=os.path.getmtime):
+        kind = [k for k, kind_data in QC_FILES.items() if file_path.endswith(kind_data['extension'])][0]
+        mod_type = get_qc_mod_type(file_path=file_path, mod_types=mod_types)
+        sample = get_qc_sample_name(file_path=file_path, mod_type=mod_type)
+        qc_files.setdefault(sample, {}).setdefault(mod_type, {})[kind] = file_path
+    return qc_files
+
+
+def get_n50(length_counts:pd.Series) -> int:
+    """
+    N50 по распределению длин прочтений
+    :param length_counts: {длина:количество прочтений}
+    """
+    if length_counts.empty:
+        return 0
+    length_counts = length_counts.sort_index(ascending=False)
+    bases = (length_counts.index.to_series() * length_counts).cumsum()
+    return int(bases.index[bases >= bases.iloc[-1] / 2][0])
+
+
+def summarize_readstats(file_path:str, chunk_size:int=QC_CHUNK_SIZE) -> dict:
+    """
+    Количество прочтений, выход (оснований), N50 и среднее качество прочтений по .readstats.tsv.gz.
+    Файл читается по частям, копятся только распределение длин и суммы
+    """
+    length_counts = pd.Series(dtype='int64')
+    reads = 0
+    quality_sum = 0.0
+    for chunk in pd.read_csv(file_path, sep='\t', usecols=QC_FILES['readstats']['usecols'], chunksize=chunk_size):
+        length_counts = length_counts.add(chunk['read_length'].value_counts(), fill_value=0)
+        reads += len(chunk)
+        quality_sum += chunk['mean_quality'].sum()
+    return {'reads':reads,
+            'yield_bases':int((length_counts.index.to_series() * length_counts).sum()),
+            'read_n50':get_n50(length_counts=length_counts),
+            'mean_read_quality':quality_sum / reads if reads else None}
+
+
+def summarize_flagstats(file_path:str) -> dict:
+    """Количество первичных, вторичных, дополнительных и неоткартированных выравниваний и доля откартированных прочтений"""
+    flagstats = pd.read_csv(file_path, sep='\t', usecols=QC_FILES['flagstats']['usecols'])
+    totals = flagstats.drop(columns='ref').sum()
+    primary = int(totals['primary'])
+    return {'primary_alignments':primary,
+            'secondary_alignments':int(totals['secondary']),
+            'supplementary_alignments':int(totals['supplementary']),
+            'unmapped_reads':int(totals['unmapped']),
+            'mapped_fraction':(primary - int(totals['unmapped'])) / primary if primary else None}
+
+
+def summarize_mosdepth(file_path:str) -> dict:
+    """Среднее покрытие по строке total в .mosdepth.summary.txt"""
+    summary = pd.read_csv(file_path, sep='\t', usecols=QC_FILES['mosdepth']['usecols'], index_col='chrom')
+    return {'mean_coverage':float(summary.loc['total', 'mean']) if 'total' in summary.index else None}
+
+
+def summarize_bedmethyl(file_path:str, chunk_size:int=QC_CHUNK_SIZE) -> dict:
+    """
+    Количество сайтов, валидных и модифицированных вызовов и доля модифицированных для каждого кода модификации.
+    Файл читается по частям, разделитель - любые пробельные символы (modkit пишет часть колонок через пробел)
+    """
+    totals = None
+    for chunk in pd.read_csv(file_path, sep=r'\s+', header=None, usecols=QC_FILES['bedmethyl']['usecols'], chunksize=chunk_size):
+        chunk.columns = ['code', 'valid', 'mod', 'canonical']
+        chunk_totals = chunk.groupby('code').agg(sites=('valid', 'size'), valid=('valid', 'sum'), mod=('mod', 'sum'))
+        totals = chunk_totals if totals is None else totals.add(chunk_totals, fill_value=0)
+    summary = {}
+    if totals is None:
+        return summary
+    for code, code_totals in totals.iterrows():
+        summary.update({f'{code}_sites':int(code_totals['sites']),
+                        f'{code}_valid_calls':int(code_totals['valid']),
+                        f'{code}_mod_calls':int(code_totals['mod']),
+                        f'{code}_mod_fraction':code_totals['mod'] / code_totals['valid'] if code_totals['valid'] else None})
+    return summary
+
+
+qc_summarizers = {'readstats':summarize_readstats,
+                  'flagstats':summarize_flagstats,
+                  'mosdepth':summarize_mosdepth,
+                  'bedmethyl':summarize_bedmethyl}
+
+
+def summarize_qc_file(kind:str, file_path:str) -> dict:
+    return qc_summarizers[kind](file_path)
+
+
+def load_qc_cache(file_path:str) -> dict:
+    """Кэш агрегатов: {sample:{mod_type:{kind:{'path', 'mtime', 'aggregates'}}}}, пустой, если файла нет"""
+    if not os.path.exists(file_path):
+        return {}
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def save_qc_cache(file_path:str, cache:dict) -> None:
+    """Атомарно записывает кэш агрегатов"""
+    tmp_file_path = f'{file_path}.tmp'
+    with open(tmp_file_path, 'w') as f:
+        json.dump(cache, f, indent=1)
+    os.replace(tmp_file_path, file_path)
+
+
+def summarize_cohort_qc(qc_files:dict, cache:dict, workers:int=1) -> tuple:
+    """
+    Сводка QC когорты. Агрегаты файла берутся из кэша, если путь и время изменения файла не изменились,
+    остальные файлы обрабатываются параллельно в workers процессах.
+
+    :param qc_files: результат find_qc_files
+    :param cache: результат load_qc_cache
+    :return: (таблица {(sample, mod_type): агрегаты всех файлов образца этого типа модификаций}, обновлённый кэш)
+    """
+    new_cache = {}
+    files2process = []
+    for sample, mod_types in qc_files.items():
+        new_cache[sample] = {}
+        for mod_type, kinds in mod_types.items():
+            new_cache[sample][mod_type] = {}
+            for kind, file_path in kinds.items():
+                mtime = os.path.getmtime(file_path)
+                cached = cache.get(sample, {}).get(mod_type, {}).get(kind, {})
+                if cached.get('path') == file_path and cached.get('mtime') == mtime:
+                    new_cache[sample][mod_type][kind] = cached
+                else:
+                    files2process.append((sample, mod_type, kind, file_path, mtime))
+
+    with ProcessPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = [executor.submit(summarize_qc_file, kind, file_path) for _sample, _mod_type, kind, file_path, _mtime in files2process]
+        for (sample, mod_type, kind, file_path, mtime), future in zip(files2process, futures):
+            new_cache[sample][mod_type][kind] = {'path':file_path, 'mtime':mtime, 'aggregates':future.result()}
+
+    rows = {(sample, mod_type):{k:v for kind_data in kinds.values() for k, v in kind_data['aggregates'].items()}
+            for sample, mod_types in new_cache.items() for mod_type, kinds in mod_types.items()}
+    table = pd.DataFrame.from_dict(rows, orient='index')
+    table.index = pd.MultiIndex.from_tuples(table.index, names=['sample', 'mod_type'])
+    return (table.sort_index(), new_cache)
+
+
+def write_qc_table(table:pd.DataFrame, file_path:str) -> None:
+    """Записывает сводку в Parquet (.parquet) или TSV"""
+    if file_path.endswith('.parquet'):
+        table.to_parquet(file_path)
+    else:
+        table.to_csv(file_path, sep='\t')
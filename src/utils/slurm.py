@@ -1,19 +1,139 @@
-import pyslurm
 import os
+from string import Template
+from functools import lru_cache
 from src.utils.common import run_shell_cmd
 
-def submit_slurm_job(command:str, working_dir:str, job_name:str, partition:str='', nodes:int=1, gpus:int=0,
-                     cpus_per_task:str='', mem='', ntasks:int=1, dependency:list=None, dependency_type:str='all',
-                     exclude_nodes:list=[]) -> str :
-    """Отправка задачи в SLURM
-    :param command: команда для CLI
-    :param job_name: наименование задачи
-    :param partition: на какой части кластера выполняется
-    :param nodes: количество машин для задачи
-    :param ntasks: количество задач на задание
+# Slurm states of failed jobs and retry escalation for them:
+# 'mem' - more RAM, 'time' - more walltime, 'node' - exclude node where job failed
+RETRYABLE_JOB_STATES = {'OUT_OF_MEMORY':'mem', 'TIMEOUT':'time', 'FAILED':'node', 'NODE_FAIL':'node', 'BOOT_FAIL':'node'}
+# exit codes of jobs, which failed because of broken data (check_integrity.py): retry won't help
+NON_RETRYABLE_EXIT_CODES = ['3:0']
+
+# sbatch script template: $job_name, $options ('#SBATCH --opt=val' lines) and $command
+SLURM_SCRIPT_TEMPLATE = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                     'configs', 'slurm_script_template.sh')
+# limits of partitions and nodes in pyslurm above these values mean "no limit"
+SLURM_INFINITE = 0xfffffff0
+
+
+@lru_cache(maxsize=None)
+def load_slurm_script_template(file_path:str=SLURM_SCRIPT_TEMPLATE) -> Template:
+    """Загружает шаблон скрипта sbatch (один раз за запуск)"""
+    with open(file_path, 'r') as t:
+        return Template(t.read())
+
+
+def get_slurm_options(working_dir:str, partition:str='', nodes:int=1, gpus:int=0, cpus_per_task:str='',
+                      cpus_per_gpu:str='', mem='', ntasks:int=1, dependency:list=None, dependency_type:str='all',
+                      kill_on_invalid_dep:bool=True, exclude_nodes:list=[], time:str='8:00:00', begin:str='', array:str='',
+                      mail_type:str='', mail_user:str='') -> dict:
+    """
+    Опции sbatch задачи (пустые опции не передаются)
     :param dependency: задачи, по успешному завершению которых будет запущено задание
     :param dependency_type: тип зависимости от задач - должны быть успешно выполнены все либо любая из задач ('all','any')
-    :return: id задачи Slurm
+    :param kill_on_invalid_dep: снимать задачу из очереди, если зависимость уже не может быть выполнена
+    :param begin: время, не раньше которого задача будет запущена ('now+1hour', '2024-05-01T20:00:00')
+    :param array: индексы массива задач ('0-15', '1,3,5%2')
+    :param mail_type: события для уведомлений ('END', 'FAIL', 'END,FAIL')
+    :return: {opt:val}
+    """
+    if dependency_type not in ['all', 'any']:
+        raise ValueError(f"Неизвестный тип зависимости: {dependency_type}")
+    delimiter = ':' if dependency_type == 'all' else '?'
+    opts = {'partition':partition,
+            'nodes':str(nodes),
+            'ntasks':str(ntasks),
+            'cpus-per-task':str(cpus_per_task),
+            'cpus-per-gpu':str(cpus_per_gpu),
+            'mem':f'{str(mem)}G' if mem else '',
+            'gpus-per-task':gpus,
+            'array':array,
+            'dependency':f"afterok:{delimiter.join([str(d) for d in dependency])}" if dependency else '',
+            'kill-on-invalid-dep':'yes' if dependency and kill_on_invalid_dep else '',
+            'exclude':','.join(exclude_nodes),
+            'chdir':working_dir,
+            'time':time,
+            'begin':begin,
+            'mail-type':mail_type,
+            'mail-user':mail_user}
+    return {opt:val for opt, val in opts.items() if val}
+
+
+def render_slurm_script(command:str, job_name:str, options:dict) -> str:
+    """Скрипт sbatch по шаблону SLURM_SCRIPT_TEMPLATE"""
+    return load_slurm_script_template().substitute(job_name=job_name, command=command,
+                                                   options='\n'.join([f'#SBATCH --{opt}={val}' for opt, val in options.items()]))
+
+
+def slurm_time_to_minutes(time:str) -> float:
+    """
+    Лимит времени в минутах. Форматы sbatch: MM, MM:SS, HH:MM:SS, D-HH, D-HH:MM, D-HH:MM:SS,
+    а также UNLIMITED (бесконечность)
+    """
+    if time.upper() in ['UNLIMITED', 'INFINITE']:
+        return float('inf')
+    days, _, hms = time.rpartition('-')
+    parts = [int(p) for p in hms.split(':')]
+    if days:
+        # with days: HH, HH:MM or HH:MM:SS
+        parts = parts + [0] * (3 - len(parts))
+    elif len(parts) < 3:
+        # without days: MM or MM:SS
+        parts = [0] + parts + [0] * (2 - len(parts))
+    return int(days or 0) * 24 * 60 + parts[0] * 60 + parts[1] + parts[2] / 60
+
+
+@lru_cache(maxsize=None)
+def get_partition_limits() -> dict:
+    """
+    Ограничения разделов Slurm (читаются из pyslurm один раз за запуск):
+    максимальное время и количество нод раздела, максимум CPU и памяти (Gb) на ноду раздела.
+    None - без ограничения
+    :return: {partition:{'max_time', 'max_nodes', 'max_cpus', 'max_mem'}}
+    """
+    def limit(val):
+        return val if isinstance(val, int) and 0 < val < SLURM_INFINITE else None
+
+    import pyslurm
+    nodes = pyslurm.node().get()
+    limits = {}
+    for partition, data in pyslurm.partition().get().items():
+        partition_nodes = [n for n in nodes.values() if partition in (n.get('partitions') or [])]
+        limits[partition] = {'max_time':limit(data.get('max_time')),
+                             'max_nodes':limit(data.get('max_nodes')),
+                             'max_cpus':max([n.get('cpus') or 0 for n in partition_nodes], default=0) or None,
+                             'max_mem':max([n.get('real_memory') or 0 for n in partition_nodes], default=0) // 1024 or None}
+    return limits
+
+
+def validate_slurm_options(options:dict, limits:dict) -> None:
+    """
+    Проверяет запрошенные ресурсы задачи по ограничениям раздела (get_partition_limits),
+    чтобы задача не висела в очереди с PartitionTimeLimit или не отклонялась sbatch
+    :param options: результат get_slurm_options
+    """
+    partition = options.get('partition')
+    if not partition:
+        return
+    if partition not in limits:
+        raise ValueError(f"Раздел Slurm не найден: {partition}")
+    partition_limits = limits[partition]
+    requested = {'max_time':slurm_time_to_minutes(options['time']) if options.get('time') else None,
+                 'max_nodes':int(options.get('nodes', 1)),
+                 'max_cpus':int(options['cpus-per-task']) if options.get('cpus-per-task') else None,
+                 'max_mem':int(options['mem'].rstrip('G')) if options.get('mem') else None}
+    errors = [f"{limit}: {val} > {partition_limits[limit]}" for limit, val in requested.items()
+              if val is not None and partition_limits.get(limit) is not None and val > partition_limits[limit]]
+    if errors:
+        raise ValueError(f"Задача превышает ограничения раздела {partition}: {', '.join(errors)}")
+
+
+def prepare_slurm_script(command:str, working_dir:str, job_name:str, validate:bool=True, **options) -> str:
+    """
+    Проверяет параметры задачи, рендерит скрипт в памяти и записывает его в working_dir
+    (скрипт нужен для повторного запуска задачи, см. escalate_slurm_script)
+    :param options: параметры get_slurm_options
+    :return: путь к скрипту
     """
     if not command:
         raise ValueError('Empty CMD for sbatch script')
@@ -21,66 +141,234 @@ def submit_slurm_job(command:str, working_dir:str, job_name:str, partition:str='
         raise ValueError('Work dir not specified')
     elif not job_name:
         raise ValueError('Job name not specified')
-    
-    slurm_script = ['#!/bin/bash\n']
+
+    slurm_options = get_slurm_options(working_dir=working_dir, **options)
+    if validate:
+        validate_slurm_options(options=slurm_options, limits=get_partition_limits())
     slurm_script_file = os.path.join(working_dir, f'{job_name}.sh')
-    option_str = '#SBATCH --{}={}'
+    with open(slurm_script_file, 'w') as s:
+        s.write(render_slurm_script(command=command, job_name=job_name, options=slurm_options))
+    return slurm_script_file
 
-    opts = {'job-name':job_name,
-            'partition':partition,
-            'nodes':str(nodes),
-            'ntasks':str(ntasks),
-            'cpus-per-task':str(cpus_per_task),
-            'mem':mem,
-            'gpus-per-task':gpus,
-            'dependency':dependency,
-            'exclude':exclude_nodes,
-            'chdir':working_dir,
-            'time':'8:00:00',
-            'command':command
-            }    
-
-    for opt,val in opts.items():
-        if opt != 'command':
-            if val:
-                if opt == 'dependency':
-                    if dependency_type == 'all':
-                        delimiter = ':'
-                    elif dependency_type == 'any':
-                        delimiter = '?'
-                    val = f"afterok:{f'{delimiter}'.join(dependency)}"
-                if opt == 'exclude':
-                    val = ','.join(exclude_nodes)
-                if opt == 'mem':
-                    val = f'{str(mem)}G'
-                slurm_script.append(option_str.format(opt, val))
-        else:
-            slurm_script.extend(['\n', val])
 
-    with open(slurm_script_file, 'w') as s:
-        s.write('\n'.join(slurm_script))
-    slurm_stdout, slurm_stderr = run_shell_cmd(cmd=f"sbatch {slurm_script_file}")
+def submit_slurm_job(command:str, working_dir:str, job_name:str, **options) -> str :
+    """Отправка задачи в SLURM
+    :param command: команда для CLI
+    :param job_name: наименование задачи
+    :param options: параметры get_slurm_options (partition, nodes, ntasks, cpus_per_task, mem, dependency, time, ...)
+    :return: id задачи Slurm
+    """
+    slurm_script_file = prepare_slurm_script(command=command, working_dir=working_dir, job_name=job_name, **options)
+    job_id = sbatch_script(slurm_script_file=slurm_script_file)
+    if not job_id:
+        raise ValueError(f'sbatch не принял задачу {slurm_script_file}')
+    return job_id
+
+
+def submit_slurm_jobs(jobs:list) -> list:
+    """
+    Пакетная отправка задач: все скрипты проверяются и рендерятся до отправки
+    (ошибка в любой задаче не оставит в очереди часть пакета), затем отправляются одним вызовом оболочки,
+    если sbatch не принял часть скриптов, уже отправленные задачи пакета отменяются (см. sbatch_scripts)
+    :param jobs: [{'command', 'working_dir', 'job_name', параметры get_slurm_options}]
+    :return: id задач Slurm в порядке jobs
+    """
+    return sbatch_scripts(slurm_script_files=[prepare_slurm_script(**job) for job in jobs])
+
+
+def sbatch_script(slurm_script_file:str) -> str:
+    """
+    Отправка готового скрипта в sbatch.
+    id задачи берётся из вывода sbatch --parsable, а не из squeue по имени:
+    при повторном запуске в очереди может оказаться несколько задач с одним именем
+    :return: id задачи Slurm
+    """
+    slurm_stdout, slurm_stderr = run_shell_cmd(cmd=f"sbatch --parsable {slurm_script_file}")
+
+    if slurm_stderr:
+        print(slurm_stderr)
+
+    # --parsable: "job_id" или "job_id;cluster"
+    job_id = slurm_stdout.strip().split(';')[0]
+    #print(f'Job ID for {slurm_script_file}: {job_id}')
+    return job_id
+
+
+def sbatch_scripts(slurm_script_files:list) -> list:
+    """
+    Отправка нескольких готовых скриптов в sbatch одним вызовом оболочки.
+    Для каждого скрипта выводится ровно одна строка: id задачи или пустая строка, если sbatch его не принял.
+    Пакет отправляется целиком или не отправляется: при отказе sbatch принятые задачи пакета отменяются
+    :return: id задач Slurm в порядке скриптов
+    """
+    if not slurm_script_files:
+        return []
+    slurm_stdout, slurm_stderr = run_shell_cmd(cmd='; '.join([f"echo \"$(sbatch --parsable {f})\"" for f in slurm_script_files]))
 
     if slurm_stderr:
         print(slurm_stderr)
 
-    job_id, stderr = run_shell_cmd(cmd=f"squeue -n {job_name} | tail -1| awk '{{print $1}}'")
-    #print(f'Job ID for {job_name}: {job_id}')
-    return job_id.removesuffix('\n')
+    # --parsable: "job_id" или "job_id;cluster"
+    job_ids = [line.strip().split(';')[0] for line in slurm_stdout.splitlines()]
+    if len(job_ids) != len(slurm_script_files) or not all(job_ids):
+        for job_id in filter(None, job_ids):
+            cancel_slurm_job(job_to_cancel=job_id)
+        rejected = [f for f, job_id in zip(slurm_script_files, job_ids + [''] * len(slurm_script_files)) if not job_id]
+        raise ValueError(f"sbatch не принял скрипты {', '.join(rejected)}, отправленные задачи пакета отменены")
+    return job_ids
+
+
+def classify_job_failure(job_state:str, exit_code:str='') -> str:
+    """
+    Определяет причину падения задачи и способ повторного запуска
+    :param job_state: состояние задачи в Slurm
+    :param exit_code: код выхода в формате Slurm ('137:0', '0:9')
+    :return: 'mem', 'time', 'node' или пустая строка, если задачу перезапускать не нужно
+    """
+    if exit_code in NON_RETRYABLE_EXIT_CODES:
+        return ''
+    action = RETRYABLE_JOB_STATES.get(job_state, '')
+    # job killed by SIGKILL (OOM killer outside of cgroup accounting) is reported just as FAILED
+    if action == 'node' and exit_code in ['137:0', '0:9']:
+        action = 'mem'
+    return action
+
+
+def minutes_to_slurm_time(minutes:int) -> str:
+    """Лимит времени в минутах в формате D-HH:MM:SS"""
+    return f'{minutes // (24 * 60)}-{minutes % (24 * 60) // 60:02d}:{minutes % 60:02d}:00'
+
+
+def scale_slurm_time(time:str, factor:float, max_minutes:int=None) -> str:
+    """Увеличивает лимит времени в factor раз, но не больше max_minutes (UNLIMITED не меняется)"""
+    minutes = slurm_time_to_minutes(time=time)
+    if minutes == float('inf'):
+        return time
+    minutes = int(minutes * factor + 0.5)
+    return minutes_to_slurm_time(minutes=min(minutes, max_minutes) if max_minutes else minutes)
+
+
+def escalate_slurm_script(slurm_script_file:str, action:str, failed_node:str='', mem_factor:float=2, time_factor:float=2,
+                          limits:dict=None) -> str:
+    """
+    Правит скрипт упавшей задачи для повторного запуска: увеличивает память или время, либо исключает ноду.
+    Память и время увеличиваются не больше ограничений раздела задачи, иначе sbatch отклонит задачу.
+    Зависимости из скрипта убираются - задача перезапускается после того, как предыдущие этапы уже выполнены.
+    :param slurm_script_file: скрипт задачи, созданный submit_slurm_job
+    :param action: результат classify_job_failure
+    :param failed_node: нода, на которой упала задача
+    :param limits: ограничения разделов (get_partition_limits)
+    :return: путь к исправленному скрипту или пустая строка, если память или время уже упираются в ограничения раздела
+    """
+    with open(slurm_script_file, 'r') as s:
+        slurm_script = s.read().split('\n')
+
+    option_str = '#SBATCH --{}={}'
+    options = {}
+    for line in slurm_script:
+        if line.startswith('#SBATCH --') and '=' in line:
+            opt, val = line.removeprefix('#SBATCH --').split('=', 1)
+            options[opt] = val
+    partition_limits = (limits or {}).get(options.get('partition'), {})
+
+    if action == 'mem' and options.get('mem'):
+        mem = float(options['mem'].rstrip('G'))
+        new_mem = int(mem * mem_factor)
+        if partition_limits.get('max_mem'):
+            new_mem = min(new_mem, partition_limits['max_mem'])
+        if new_mem <= mem:
+            return ''
+        options['mem'] = f'{new_mem}G'
+    elif action == 'time':
+        time = options.get('time', '8:00:00')
+        options['time'] = scale_slurm_time(time=time, factor=time_factor, max_minutes=partition_limits.get('max_time'))
+        if slurm_time_to_minutes(time=options['time']) <= slurm_time_to_minutes(time=time):
+            return ''
+    elif action == 'node' and failed_node:
+        excluded = [n for n in options.get('exclude', '').split(',') if n]
+        options['exclude'] = ','.join(excluded + [n for n in failed_node.split(',') if n not in excluded])
+    options.pop('dependency', None)
+
+    # options keep their places, new ones are added after the last option
+    last_option = max([i for i, line in enumerate(slurm_script) if line.startswith('#SBATCH')])
+    new_script = []
+    for i, line in enumerate(slurm_script):
+        if line.startswith('#SBATCH --') and '=' in line:
+            opt = line.removeprefix('#SBATCH --').split('=', 1)[0]
+            if opt in options:
+                new_script.append(option_str.format(opt, options.pop(opt)))
+        else:
+            new_script.append(line)
+        if i == last_option:
+            new_script.extend([option_str.format(opt, val) for opt, val in options.items()])
+
+    with open(slurm_script_file, 'w') as s:
+        s.write('\n'.join(new_script))
+    return slurm_script_file
 
 
 def cancel_slurm_job(job_to_cancel:int) -> None:
     os.system(f'scancel {job_to_cancel}')
 
 
-def get_slurm_job_status() -> dict:
-    """Проверка статуса задачи через pyslurm"""
+def get_slurm_job_status(job_ids:list=None) -> dict:
+    """
+    Проверка статуса задачи через pyslurm.
+    Завершённые задачи удаляются из slurmctld через MinJobAge и могут не попасть в снимок очереди,
+    поэтому состояние задач из job_ids, которых в снимке нет, берётся из sacct
+    :param job_ids: отслеживаемые задачи
+    :return: {job_id:{'job_state', 'name', 'nodes', 'exit_code', ...}}
+    """
+    # pyslurm is imported only when Slurm is really used (not for --help, --dry_run or tests)
+    import pyslurm
     job_data = pyslurm.job().get().copy()
+    missing_jobs = [str(job) for job in job_ids or [] if int(job) not in job_data]
+    accounting = get_slurm_job_accounting(job_ids=missing_jobs)
+    for job in missing_jobs:
+        if job in accounting:
+            job_data[int(job)] = {'job_state':accounting[job]['state'], 'name':accounting[job]['job_name'],
+                                  'nodes':accounting[job]['nodes'], 'exit_code':accounting[job]['exit_code']}
     return job_data
     
 
+def get_slurm_job_accounting(job_ids:list) -> dict:
+    """
+    Получение учётных данных задач из sacct (в отличие от pyslurm, доступны и после того,
+    как задача ушла из slurmctld)
+    :param job_ids: id задач Slurm
+    :return: {job_id:{'job_name', 'state', 'submit', 'start', 'end', 'nodes', 'exit_code', 'requeues'}}
+    """
+    if not job_ids:
+        return {}
+    fields = ['JobID', 'JobName', 'State', 'Submit', 'Start', 'End', 'NodeList', 'ExitCode']
+    # -D: перезапуски задачи (requeue) выводятся отдельными строками с тем же JobID
+    stdout, stderr = run_shell_cmd(cmd=f"sacct -X -D --noheader --parsable2 --format={','.join(fields)} -j {','.join([str(j) for j in job_ids])}")
+    if stderr:
+        print(stderr)
+
+    accounting = {}
+    for line in stdout.splitlines():
+        vals = line.split('|')
+        if len(vals) != len(fields):
+            continue
+        record = dict(zip(fields, vals))
+        job_id = record['JobID']
+        requeues = accounting[job_id]['requeues'] + 1 if job_id in accounting else 0
+        # 'CANCELLED by 1234' -> 'CANCELLED'
+        accounting[job_id] = {'job_name':record['JobName'],
+                              'state':record['State'].split(' ')[0],
+                              'submit':record['Submit'],
+                              'start':record['Start'],
+                              'end':record['End'],
+                              'nodes':record['NodeList'],
+                              'exit_code':record['ExitCode'],
+                              'requeues':requeues}
+    return accounting
+
+
 def get_idle_nodes(partition_name:str) -> list:
     """Получение списка простаивающих узлов"""
+    import pyslurm
     nodes = pyslurm.node().get()
     idle_nodes = [node for node, data in nodes.items() if data['state'] == 'IDLE' and partition_name in data['partitions']]
     return idle_nodes
\ No newline at end of file